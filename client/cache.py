@@ -0,0 +1,327 @@
+#!/usr/bin/env python
+"""
+Client side caches for the HT backed file systems in client.py and
+multi_cs.py. Entries remember the version SimpleHT reported for the key they
+were read from, so a stale entry can be revalidated with one small version()
+call instead of fetching the value again.
+"""
+
+from bisect import bisect_left
+from collections import OrderedDict
+from Queue import Queue
+from threading import Lock, Thread
+from time import sleep, time
+
+# Seconds cached attributes and pages are used without asking the server
+ATTR_TTL = 1.0
+
+# File contents are cached in pages of PAGE_SIZE bytes, CACHE_BYTES in all
+PAGE_SIZE = 64 * 1024
+CACHE_BYTES = 64 * 1024 * 1024
+
+# A handle writes back on its own once it buffers this many bytes, or once
+# its oldest buffered write is this many seconds old
+WRITE_BUFFER = 4 * 1024 * 1024
+WRITE_AGE = 5.0
+# Seconds between the flusher's looks for buffers past their age
+FLUSH_INTERVAL = 1.0
+
+# Pages read ahead of a sequential reader, the window doubles from the
+# minimum while reads stay sequential and halves on a random one
+READAHEAD_MIN = 2
+READAHEAD_MAX = 32
+PREFETCH_THREADS = 2
+
+class AttrCache:
+    """getattr results by path. An entry younger than ttl is returned as is,
+    an older one is handed back as stale for the caller to revalidate."""
+    def __init__(self, ttl=ATTR_TTL):
+        self.ttl = ttl
+        self.lock = Lock()
+        # path -> [attrs, version, time it was last validated]
+        self.entries = {}
+
+    # Returns (attrs, version, fresh), or None if path is not cached
+    def lookup(self, path):
+        with self.lock:
+            ent = self.entries.get(path)
+            if ent is None:
+                return None
+            return dict(ent[0]), ent[1], time() - ent[2] < self.ttl
+
+    def store(self, path, attrs, version):
+        with self.lock:
+            self.entries[path] = [dict(attrs), version, time()]
+
+    # The server still has the cached version, trust it for another ttl
+    def revalidated(self, path):
+        with self.lock:
+            ent = self.entries.get(path)
+            if ent is not None:
+                ent[2] = time()
+
+    def invalidate(self, path):
+        with self.lock:
+            self.entries.pop(path, None)
+
+    # Drop path and every path below it
+    def invalidate_tree(self, path):
+        below = path.rstrip('/') + '/'
+        with self.lock:
+            for p in self.entries.keys():
+                if p == path or p.startswith(below):
+                    del self.entries[p]
+
+
+class BlockCache:
+    """Fixed size pages of file contents, keyed by (key, page number) and
+    evicted least recently used first once they take more than budget bytes.
+    The pages of a key are only trusted for ttl seconds after its version was
+    last checked; a changed version drops them all."""
+    def __init__(self, budget=CACHE_BYTES, page_size=PAGE_SIZE, ttl=ATTR_TTL):
+        self.budget = budget
+        self.page_size = page_size
+        self.ttl = ttl
+        self.lock = Lock()
+        self.pages = OrderedDict()
+        self.size = 0
+        # key -> page numbers cached for it
+        self.index = {}
+        # key -> [version, time it was last validated]
+        self.versions = {}
+        # key -> number of times its pages were dropped, so a page fetched
+        # before that is not put back afterwards
+        self.generations = {}
+
+    # Whether the version of key needs checking before its pages are used
+    def stale(self, key):
+        with self.lock:
+            ent = self.versions.get(key)
+            return ent is None or time() - ent[1] >= self.ttl
+
+    # Record the version the server reported for key, dropping its pages if
+    # they were read at another version
+    def validate(self, key, version):
+        with self.lock:
+            ent = self.versions.get(key)
+            if ent is not None and ent[0] != version:
+                self.drop(key)
+            self.versions[key] = [version, time()]
+
+    def get(self, key, page):
+        with self.lock:
+            data = self.pages.pop((key, page), None)
+            if data is not None:
+                # Move to the most recently used end
+                self.pages[(key, page)] = data
+            return data
+
+    def generation(self, key):
+        with self.lock:
+            return self.generations.get(key, 0)
+
+    # Whether (key, page) is cached, without touching its LRU position
+    def __contains__(self, item):
+        with self.lock:
+            return item in self.pages
+
+    # gen, if given, is generation(key) from before data was fetched
+    def put(self, key, page, data, gen=None):
+        with self.lock:
+            if gen is not None and self.generations.get(key, 0) != gen:
+                return
+            old = self.pages.pop((key, page), None)
+            if old is not None:
+                self.size -= len(old)
+            self.pages[(key, page)] = data
+            self.size += len(data)
+            self.index.setdefault(key, set()).add(page)
+            while self.size > self.budget:
+                (k, p), evicted = self.pages.popitem(last=False)
+                self.size -= len(evicted)
+                self.index[k].discard(p)
+                if not self.index[k]:
+                    del self.index[k]
+
+    # Forget everything about key, e.g. after writing to it
+    def invalidate(self, key):
+        with self.lock:
+            self.drop(key)
+            self.versions.pop(key, None)
+
+    def drop(self, key):
+        self.generations[key] = self.generations.get(key, 0) + 1
+        for page in self.index.pop(key, ()):
+            self.size -= len(self.pages.pop((key, page)))
+
+
+
+class Readahead:
+    """Sequential read detection for one open handle. access() is told about
+    every read and answers with the pages to prefetch, if any."""
+    def __init__(self, lo=READAHEAD_MIN, hi=READAHEAD_MAX):
+        self.lo = lo
+        self.hi = hi
+        self.lock = Lock()
+        self.window = 0
+        # Where the next read starts if the reader is sequential
+        self.next = 0
+        # First page not prefetched yet
+        self.issued = 0
+
+    # Returns (first, last) pages to prefetch after a read, or None
+    def access(self, offset, size, page_size):
+        with self.lock:
+            if offset == self.next and size:
+                self.window = min(max(self.window * 2, self.lo), self.hi)
+            else:
+                self.window //= 2
+                self.issued = 0
+            self.next = offset + size
+            if not self.window:
+                return None
+            last = (offset + size - 1) // page_size
+            first = max(self.issued, last + 1)
+            if first > last + self.window:
+                return None
+            self.issued = last + self.window + 1
+            return first, last + self.window
+
+
+class Prefetcher:
+    """A few daemon threads running readahead jobs, so that read() returns
+    without waiting for them. A failed job only costs the prefetch."""
+    def __init__(self, threads=PREFETCH_THREADS):
+        self.threads = threads
+        self.queue = None
+        self.lock = Lock()
+
+    def submit(self, job, *args):
+        with self.lock:
+            if self.queue is None:
+                self.queue = Queue()
+                for i in range(self.threads):
+                    t = Thread(target=self.run)
+                    t.setDaemon(True)
+                    t.start()
+        self.queue.put((job, args))
+
+    def run(self):
+        while True:
+            job, args = self.queue.get()
+            try:
+                job(*args)
+            except Exception:
+                pass
+
+
+class WriteBuffer:
+    """Writes through one open handle that have not reached the server yet,
+    as sorted, non overlapping [offset, bytearray] extents. Overlapping and
+    adjacent writes are merged, so a sequential copy stays a single extent
+    that is written back with one write_range call."""
+    def __init__(self, ino, limit=WRITE_BUFFER, age=WRITE_AGE):
+        self.ino = ino
+        self.limit = limit
+        self.age = age
+        self.lock = Lock()
+        # Held while the extents taken out are on their way to the server
+        self.flushing = Lock()
+        self.extents = []
+        self.size = 0
+        self.since = None
+
+    # Buffer data at offset, returns True once it is time to write back
+    def add(self, offset, data):
+        end = offset + len(data)
+        with self.lock:
+            ext = self.extents
+            if self.since is None:
+                self.since = time()
+            lo = bisect_left([e[0] for e in ext], offset)
+            if lo and ext[lo - 1][0] + len(ext[lo - 1][1]) >= offset:
+                lo -= 1
+            hi = lo
+            while hi < len(ext) and ext[hi][0] <= end:
+                hi += 1
+            if lo == hi:
+                ext.insert(lo, [offset, bytearray(data)])
+                self.size += len(data)
+            elif hi == lo + 1 and ext[lo][0] <= offset:
+                # Overwrite or append within one extent, in place
+                start, buf = ext[lo]
+                self.size -= len(buf)
+                buf[offset - start:end - start] = data
+                self.size += len(buf)
+            else:
+                start = min(offset, ext[lo][0])
+                stop = max(end, ext[hi - 1][0] + len(ext[hi - 1][1]))
+                buf = bytearray(stop - start)
+                for s, b in ext[lo:hi]:
+                    buf[s - start:s - start + len(b)] = b
+                    self.size -= len(b)
+                buf[offset - start:end - start] = data
+                ext[lo:hi] = [[start, buf]]
+                self.size += len(buf)
+            return self.size >= self.limit or time() - self.since >= self.age
+
+    # Hand over the buffered extents as (offset, str) and start afresh
+    def take(self):
+        with self.lock:
+            extents = [(s, str(b)) for s, b in self.extents]
+            self.extents = []
+            self.size = 0
+            self.since = None
+            return extents
+
+    # End of the last buffered byte, 0 if nothing is buffered
+    def end(self):
+        with self.lock:
+            if not self.extents:
+                return 0
+            return self.extents[-1][0] + len(self.extents[-1][1])
+
+    # Whether the oldest buffered write is age seconds old by now
+    def expired(self, now=None):
+        with self.lock:
+            return self.since is not None and (now or time()) - self.since >= self.age
+
+
+class Flusher:
+    """A daemon thread writing back the buffers past their age, so writes
+    through a handle that went idle do not wait for it to be closed.
+    buffers() lists the WriteBuffers to look at and write_back(buf) sends
+    one; a failed write back does not stop the thread."""
+    def __init__(self, buffers, write_back, interval=FLUSH_INTERVAL):
+        self.buffers = buffers
+        self.write_back = write_back
+        self.interval = interval
+        self.thread = None
+        self.lock = Lock()
+
+    # Starts the thread, once
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = Thread(target=self.run)
+                self.thread.setDaemon(True)
+                self.thread.start()
+
+    def run(self):
+        while True:
+            sleep(self.interval)
+            self.flush()
+
+    # Write back every buffer past its age, returns how many were
+    def flush(self):
+        now = time()
+        flushed = 0
+        for buf in self.buffers():
+            if not buf.expired(now):
+                continue
+            try:
+                self.write_back(buf)
+                flushed += 1
+            except Exception:
+                pass
+        return flushed
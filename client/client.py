@@ -3,26 +3,104 @@
 Author: David Wolinsky
 Version: 0.01
 
-A file system that interacts with an xmlrpc HT.
+A file system that interacts with an xmlrpc HT, or over the binary transport
+of transport.py for a server given as ht://host:port or ht+unix:///path.
 """
 
 from collections import defaultdict
-from errno import ENOENT
-from stat import S_IFDIR, S_IFLNK, S_IFREG
+from contextlib import contextmanager
+from errno import ENOENT, ENOTEMPTY
+from stat import S_IFDIR, S_IFLNK, S_IFREG, S_ISDIR
 from sys import argv, exit
-from time import time
+from time import sleep, time
 
 from fuse import FUSE, FuseOSError, Operations, LoggingMixIn
+from cache import AttrCache, BlockCache, WriteBuffer, Readahead, Prefetcher, Flusher
+from cache import ATTR_TTL, CACHE_BYTES, PAGE_SIZE
+from transport import Pipeline, Pool, POOL_SIZE
+from retry import LockStats, RetryPolicy
 from xmlrpclib import Binary
-import sys, pickle, xmlrpclib
-import copy
+import sys, pickle, xmlrpclib, threading, uuid
+
+# Seconds a blocking lock request may stay parked on the server before the
+# client re-issues it
+LOCK_WAIT = 10
+# Letter of the lock calls for each lock op of Memory
+LOCK_OPS = dict(read='r', write='w', delete='d')
+
+# Whether a status returned by a lock call grants the lock
+def lock_granted(status):
+    if isinstance(status, tuple):
+        status = sum(status)
+    return status == 0
+
+# Every path is stored under three keys: its attributes under the path itself,
+# and its contents (file data, symlink target or directory listing) and its
+# extended attributes under keys of their own. getattr and friends then only
+# move the few hundred bytes of the attributes, and reads and writes only the
+# bytes they touch
+def data_key(path):
+    return path + '#data'
+
+def xattr_key(path):
+    return path + '#xattr'
+
+# The contents of a regular file are split into BLOCK_SIZE blocks, block n
+# under block_key(path, n); the inode records st_size and the number of
+# blocks. A block may be short or missing, reading as zeros up to st_size
+BLOCK_SIZE = PAGE_SIZE
+
+def block_key(path, n):
+    return '%s#%d' % (path, n)
+
+def nblocks(size):
+    return (size + BLOCK_SIZE - 1) // BLOCK_SIZE
+
+# Inode id of the root directory, every other inode gets a new_ino()
+ROOT = 'root'
+
+def new_ino():
+    return uuid.uuid4().hex
+
+# (parent directory, last component) of an absolute path
+def split_path(path):
+    parent, name = path.rstrip('/').rsplit('/', 1)
+    return parent or '/', name
+
+# Directory entries listed per dir_list call
+DIR_PAGE = 1000
 
 class HtProxy:
     """ Wrapper functions so the FS doesn't need to worry about HT primitives."""
 # A hashtable supporting atomic operations, i.e., retrieval and setting
 # must be done in different operations
-    def __init__(self, url):
-        self.rpc = xmlrpclib.Server(url)
+    def __init__(self, url, pool=POOL_SIZE):
+        # Up to pool connections, shared by every thread
+        self.rpc = Pool(url, pool)
+        self.url = url
+        self.pipeline = Pipeline()
+        # Whether the server has the wait_*_lock calls, older ones are polled
+        self.blocking = True
+
+    # Run independent (func, args...) calls at the same time, see Pipeline
+    def gather(self, *calls):
+        return self.pipeline.gather(*calls)
+
+    # Values of keys, None for missing ones
+    def get_many(self, keys):
+        return [res["value"].data if "value" in res else None
+                for res in self.rpc.multi_get([Binary(key) for key in keys])]
+
+    # Store every (key, val, ttl) of items in one call
+    def put_many(self, items):
+        self.rpc.multi_put([(Binary(key), Binary(val), ttl) for key, val, ttl in items])
+
+    # write_range for every (key, offset, data) of writes, in one multicall
+    def write_ranges(self, writes, ttl=10000):
+        multi = xmlrpclib.MultiCall(self.rpc)
+        for key, offset, data in writes:
+            multi.write_range(Binary(key), offset, Binary(data), ttl)
+        tuple(multi())
 
     # Retrieves a value from the SimpleHT, returns KeyError, like dictionary, if
     # there is no entry in the SimpleHT
@@ -34,7 +112,7 @@ class HtProxy:
     
 # Stores a value in the SimpleHT
     def __setitem__(self, key, value):
-        self.put(key, pickle.dumps(value))
+        self.put(key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
 
 # Sets the TTL for a key in the SimpleHT to 0, effectively deleting it
     def __delitem__(self, key):
@@ -52,6 +130,17 @@ class HtProxy:
         else:
             return None
 
+    # Returns the value (None if there is no entry) and its version
+    def fetch(self, key):
+        res = self.rpc.get(Binary(key))
+        if "value" in res:
+            return res["value"].data, res["version"]
+        else:
+            return None, ""
+
+    def version(self, key):
+        return self.rpc.version(Binary(key))
+
     def put(self, key, val, ttl=10000):
         return self.rpc.put(Binary(key), Binary(val), ttl)
 
@@ -74,128 +163,329 @@ class HtProxy:
         return self.rpc.release_r_lock(Binary(key), Binary(pickle.dumps(u_id)))
     
     def release_w_lock(self, key, u_id, ctx):
-        return self.rpc.release_w_lock(Binary(key), Binary(pickle.dumps(u_id)), Binary(pickle.dumps(ctx)))
+        if ctx is not None:
+            ctx = pickle.dumps(ctx, pickle.HIGHEST_PROTOCOL)
+        return self.rpc.release_w_lock(Binary(key), Binary(pickle.dumps(u_id)), Binary(ctx or ""))
+
+    """
+    byte range access to a value, the server splices the range in place
+    """
+    def read_range(self, key, offset, size):
+        return self.rpc.read_range(Binary(key), offset, size).data
+
+    def write_range(self, key, offset, data, ttl=10000):
+        return self.rpc.write_range(Binary(key), offset, Binary(data), ttl)
+
+    def truncate(self, key, length):
+        return self.rpc.truncate(Binary(key), length)
+
+    """
+    field level update of the pickled dict under key, done by the server;
+    returns the new version, or "" if key moved on from expected_version
+    """
+    def patch_attrs(self, key, delta, expected_version="", drop=()):
+        return self.rpc.patch_attrs(Binary(key), Binary(pickle.dumps(delta, pickle.HIGHEST_PROTOCOL)),
+                                    expected_version, Binary(pickle.dumps(list(drop))))
+
+    """
+    directory entries, kept by the server under dir, the key of the directory
+    """
+    def dir_add(self, dir, name, ino):
+        return self.rpc.dir_add(Binary(dir), Binary(name), Binary(ino))
+
+    def dir_remove(self, dir, name):
+        return self.rpc.dir_remove(Binary(dir), Binary(name)).data or None
+
+    def dir_lookup(self, dir, name):
+        return self.rpc.dir_lookup(Binary(dir), Binary(name)).data or None
+
+    def dir_list(self, dir, cursor, limit=DIR_PAGE):
+        return [(name.data, ino.data) for name, ino in
+                self.rpc.dir_list(Binary(dir), Binary(cursor), limit)]
+
+    # Move entry name of src to new_name in dst in one call. Returns (moved,
+    # inode replaced in dst or None)
+    def dir_rename(self, src, name, dst, new_name):
+        moved, replaced = self.rpc.dir_rename(Binary(src), Binary(name), Binary(dst), Binary(new_name))
+        return moved, replaced.data or None
+
+    """
+    blocking lock acquisition, the server parks the request until the lock is
+    granted or timeout expires; returns the same status as acquire_*_lock
+    """
+    def wait_r_lock(self, key, u_id, timeout=LOCK_WAIT):
+        return pickle.loads(self.rpc.wait_r_lock(Binary(key), Binary(pickle.dumps(u_id)), timeout).data)
+
+    def wait_w_lock(self, key, u_id, timeout=LOCK_WAIT):
+        return pickle.loads(self.rpc.wait_w_lock(Binary(key), Binary(pickle.dumps(u_id)), timeout).data)
+
+    def wait_d_lock(self, key, u_id, timeout=LOCK_WAIT):
+        return pickle.loads(self.rpc.wait_d_lock(Binary(key), Binary(pickle.dumps(u_id)), timeout).data)
+
+    # One attempt at lock op ('r', 'w' or 'd') on key, parked on the server
+    # for up to timeout seconds if it can; returns the lock status and
+    # whether it was parked
+    def try_lock(self, op, key, u_id, timeout=LOCK_WAIT):
+        if self.blocking:
+            try:
+                return getattr(self, 'wait_%s_lock' % op)(key, u_id, timeout), True
+            except xmlrpclib.Fault, fault:
+                if 'is not supported' not in fault.faultString:
+                    raise
+                self.blocking = False
+        return getattr(self, 'acquire_%s_lock' % op)(key, u_id), False
     
 class Memory(LoggingMixIn, Operations):
-    """Example memory filesystem. Supports only one level of files."""
-    def __init__(self, ht, u_id):
-        """all metadata is under [path], and data is udner [path][content],
-        which means is views "content" as a kind of metadata"""
+    """Example memory filesystem, a tree of directories kept in the HT."""
+    def __init__(self, ht, u_id, attr_ttl=ATTR_TTL, cache_bytes=CACHE_BYTES, retry=None,
+                 lock_stats=None):
+        """every file, directory and symlink is an inode whose attributes
+        are under its id; file contents are in blocks under block_key(ino, n),
+        symlink targets under data_key(ino) and xattrs under xattr_key(ino).
+        The server of data_key(ino) of a directory keeps its entries, names
+        mapped to inode ids, and the root directory is inode ROOT"""
         self.files = ht
         self.fd = 0
-	self.u_id = u_id
+        self.u_id = u_id
+        self.attrs = AttrCache(attr_ttl)
+        # path -> dict(ino=...) of recently resolved paths
+        self.names = AttrCache(attr_ttl)
+        self.pages = BlockCache(cache_bytes, BLOCK_SIZE, attr_ttl)
+        # fh -> inode id the handle was opened on, it stays with the inode
+        # when the path is renamed or unlinked
+        self.opened = {}
+        # fh -> WriteBuffer of writes not yet sent to the server
+        self.buffers = {}
+        self.buffer_lock = threading.Lock()
+        # fh -> Readahead state of the handle
+        self.readahead = {}
+        self.prefetcher = Prefetcher()
+        self.flusher = Flusher(self.handles, self.write_back)
+        # Pauses between attempts at a lock, and contention counters per key
+        self.retry = retry or RetryPolicy()
+        self.lock_stats = lock_stats or LockStats()
         now = time()
-        if '/' not in self.files:
-            self.files['/'] = dict(st_mode=(S_IFDIR | 0755), st_ctime=now,
-                                   st_mtime=now, st_atime=now, st_nlink=2, contents=['/'],
-                                   r_lock=0, w_lock=0)
+        if ROOT not in self.files:
+            self.files[ROOT] = dict(st_mode=(S_IFDIR | 0755), st_ctime=now,
+                                   st_mtime=now, st_atime=now, st_nlink=2)
    
+    """
+    acquire lock, distinguish different requests from paramenter "op" (read, write, delete)
+    Attempts are repeated as self.retry says: at once after a request that
+    was parked on the server, after a growing random pause when the server
+    has to be polled. Past the deadline the operation fails
+    """   
     def acquire_lock(self, path, op):
-        if op == 'read':
-            r = self.files.acquire_r_lock(path, self.u_id)
-            while r != 0:
-                r = self.files.acquire_r_lock(path, self.u_id)
-            return True
-        elif op == 'write':
-            re = []
-            w = self.files.acquire_w_lock(path, self.u_id)
-	    a = w[0] + w[1]
-            while a != 0:
-                w = self.files.acquire_w_lock(path, self.u_id)
-		a = w[0] + w[1]                
-            re.append(w[0])
-            re.append(w[1])
-            return re
-        elif op == 'delete':
-            d = self.files.acquire_d_lock(path, self.u_id)
-            while d != 0:
-                d = self.files.acquire_d_lock(path, self.u_id)
-            return True
-        else:
+        if op not in LOCK_OPS:
             print "acquire_lock: wrong op"
             return True
+        start = time()
+        deadline = None
+        if self.retry.deadline is not None:
+            deadline = start + self.retry.deadline
+        retries = 0
+        while True:
+            timeout = LOCK_WAIT
+            if deadline is not None:
+                timeout = max(min(timeout, deadline - time()), 0)
+            status, parked = self.files.try_lock(LOCK_OPS[op], path, self.u_id, timeout)
+            if lock_granted(status):
+                self.lock_stats.record(path, op, retries, time() - start, True)
+                return True
+            pause = 0 if parked else self.retry.delay(retries)
+            retries += 1
+            if deadline is not None:
+                left = deadline - time()
+                if left <= 0:
+                    self.lock_stats.record(path, op, retries, time() - start, False)
+                    raise FuseOSError(self.retry.error)
+                # The last attempt is made at the deadline
+                pause = min(pause, left)
+            if pause:
+                sleep(pause)
             
-            
+    """
+    release lock, distinguish different requests from paramenter "op" (read, write)
+    paramenter ctx is used to hold the data of the file for writing back;
+    a write lock released without it leaves the stored value alone.
+    """            
     def release_lock(self, path, op, ctx=None):
         if op == 'read':
             self.files.release_r_lock(path, self.u_id)
         elif op == 'write':
+            self.attrs.invalidate(path)
             self.files.release_w_lock(path, self.u_id, ctx)
         else:
             print "release_lock: wrong op" 
             
+    """
+    write lock on inode ino, held while its blocks change and released
+    without writing anything back; st_size and blocks are only changed
+    under it, through patch, so fields patched meanwhile without the lock
+    are kept
+    """
+    @contextmanager
+    def locked(self, ino):
+        self.acquire_lock(ino, 'write')
+        try:
+            yield
+        finally:
+            self.release_lock(ino, 'write')
+
+    """
+    inode id of path, found by walking its components down from the root;
+    resolved paths are remembered for the attribute ttl
+    """
+    def resolve(self, path):
+        cached = self.names.lookup(path)
+        if cached is not None and cached[2]:
+            return cached[0]['ino']
+        if path == '/':
+            return ROOT
+        parent, name = split_path(path)
+        ino = self.files.dir_lookup(data_key(self.resolve(parent)), name)
+        if ino is None:
+            raise FuseOSError(ENOENT)
+        self.names.store(path, dict(ino=ino), None)
+        return ino
+            
             
+    """
+    change attributes of inode ino with patch_attrs, no lock is taken;
+    update(attrs) returns the fields to set given the current attributes,
+    and is run again on fresh ones if they changed before the patch landed
+    """
+    def patch(self, ino, update):
+        cached = self.attrs.lookup(ino)
+        while True:
+            if cached is not None:
+                attrs, version = cached[0], cached[1]
+            else:
+                attrs, version = self.files.fetch(ino)
+                if attrs is None:
+                    raise FuseOSError(ENOENT)
+                attrs = pickle.loads(attrs)
+            applied = self.files.patch_attrs(ino, update(attrs), version)
+            self.attrs.invalidate(ino)
+            if applied:
+                return
+            cached = None
+
+
     def chmod(self, path, mode):
-        self.acquire_lock(path, 'read')
-        ht = copy.deepcopy(self.files[path])
-        self.release_lock(path, 'read')
-        
-        ht['st_mode'] &= 077000
-        ht['st_mode'] |= mode
-        
-        re = self.acquire_lock(path, 'write')
-        ht['r_lock'] = re[0]
-        ht['w_lock'] = re[1]
-        self.release_lock(path, 'write', copy.deepcopy(ht))
+        # Only the permission bits change, the file type is kept
+        self.patch(self.resolve(path),
+                   lambda attrs: dict(st_mode=attrs['st_mode'] & ~07777 | mode))
         
         return 0
 
 
     def chown(self, path, uid, gid):
-        self.acquire_lock(path, 'read')
-        ht = copy.deepcopy(self.files[path])
-        self.release_lock(path, 'read')
-        
+        ino = self.resolve(path)
+        delta = {}
         if uid != -1:
-            ht['st_uid'] = uid
+            delta['st_uid'] = uid
         if gid != -1:
-            ht['st_gid'] = gid
+            delta['st_gid'] = gid
         
-        re = self.acquire_lock(path, 'write')
-        ht['r_lock'] = re[0]
-        ht['w_lock'] = re[1]
-        self.release_lock(path, 'write', copy.deepcopy(ht))
+        self.files.patch_attrs(ino, delta)
+        self.attrs.invalidate(ino)
 
-    def create(self, path, mode):
-        self.acquire_lock('/', 'read')
-        ht = copy.deepcopy(self.files['/'])
-        self.release_lock('/', 'read')
-        
-	if path not in ht['contents']:
-	    self.files[path] = dict(st_mode=(S_IFREG | mode), st_nlink=1, st_size=0,st_ctime=time(), st_mtime=time(), st_atime=time(), contents='',r_lock=0, w_lock=0)
-                
-            ht['st_nlink'] += 1
-            ht['contents'].append(path)
-            re = self.acquire_lock('/', 'write')
-            ht['r_lock'] = re[0]
-            ht['w_lock'] = re[1]
-            self.release_lock('/', 'write', copy.deepcopy(ht))
+    """
+    adjust st_nlink of directory ino when a subdirectory comes or goes
+    """
+    def link_dir(self, ino, delta):
+        self.patch(ino, lambda attrs: dict(st_nlink=attrs['st_nlink'] + delta))
 
-            self.fd += 1
-        return self.fd	
+    """
+    store a new inode with attrs, and data under data_key, and link it into
+    the parent directory of path; returns its id, None if path exists
+    """
+    def make(self, path, attrs, data=None):
+        parent, name = split_path(path)
+        ino = new_ino()
+        calls = [(self.resolve, parent), (self.files.__setitem__, ino, attrs)]
+        if data is not None:
+            calls.append((self.files.put, data_key(ino), data))
+        try:
+            dir = self.files.gather(*calls)[0]
+        except FuseOSError:
+            # No such parent, the keys were put for nothing
+            error = sys.exc_info()
+            self.free(ino)
+            raise error[0], error[1], error[2]
+        if not self.files.dir_add(data_key(dir), name, ino):
+            self.free(ino)
+            return None
+        self.names.store(path, dict(ino=ino), None)
+        return ino
+
+    """
+    delete inode ino and everything stored under it
+    """
+    def free(self, ino):
+        with self.buffer_lock:
+            for fh, buf in self.buffers.items():
+                if buf.ino == ino:
+                    del self.buffers[fh]
+                    buf.take()
+        
+        self.acquire_lock(ino, 'delete')
+        self.attrs.invalidate(ino)
+        self.pages.invalidate(ino)
+        f = self.files.get(ino)
+        blocks = pickle.loads(f).get('blocks', 0) if f else 0
+        keys = [ino, data_key(ino), xattr_key(ino)] + [block_key(ino, n) for n in range(blocks)]
+        self.files.put_many([(key, "", 0) for key in keys])
+
+    def create(self, path, mode):
+        now = time()
+        ino = self.make(path, dict(st_mode=(S_IFREG | mode), st_nlink=1, st_size=0, blocks=0,st_ctime=now, st_mtime=now, st_atime=now))
+        return self.handle(ino or self.resolve(path))
   
     def getattr(self, path, fh=None):
-    
-        self.acquire_lock('/', 'read')
-        tmp1 = copy.deepcopy(self.files['/'])
-        self.release_lock('/', 'read')
-              
-        if path not in tmp1['contents']:
-            raise FuseOSError(ENOENT)
-        
-        self.acquire_lock(path, 'read')
-        tmp2 = copy.deepcopy(self.files[path])
-        self.release_lock(path, 'read')
+        # Served locally while fresh, then revalidated by version
+        ino = self.resolve(path)
+        cached = self.attrs.lookup(ino)
+        if cached is not None:
+            attrs, version, fresh = cached
+            if fresh:
+                return self.buffered(ino, attrs)
+            if self.files.version(ino) == version:
+                self.attrs.revalidated(ino)
+                return self.buffered(ino, attrs)
+
+        self.acquire_lock(ino, 'read')
+        try:
+            attrs, version = self.files.fetch(ino)
+        finally:
+            self.release_lock(ino, 'read')
         
-        return tmp2
+        if attrs is None:
+            self.attrs.invalidate(ino)
+            self.names.invalidate(path)
+            raise FuseOSError(ENOENT)
+        attrs = pickle.loads(attrs)
+        self.attrs.store(ino, attrs, version)
+        return self.buffered(ino, attrs)
+
+    # Grow st_size over writes to ino that are still buffered
+    def buffered(self, ino, attrs):
+        end = max([buf.end() for buf in self.handles(ino)] or [0])
+        if end > attrs.get('st_size', 0):
+            attrs['st_size'] = end
+        return attrs
   
   
     def getxattr(self, path, name, position=0):
-        self.acquire_lock(path, 'read')
-        tmp = copy.deepcopy(self.files[path])
-        attrs = tmp.get('attrs', {})
-        self.release_lock(path, 'read')
+        xattrs = xattr_key(self.resolve(path))
+        self.acquire_lock(xattrs, 'read')
+        try:
+            attrs = self.files.get(xattrs)
+        finally:
+            self.release_lock(xattrs, 'read')
         
+        attrs = pickle.loads(attrs) if attrs else {}
         try:
             return attrs[name]
         except KeyError:
@@ -203,224 +493,332 @@ class Memory(LoggingMixIn, Operations):
   
   
     def listxattr(self, path):
-        self.acquire_lock(path, 'read')
-        tmp = copy.deepcopy(self.files[path])
-        attrs = tmp.get('attrs', {}).keys()
-        self.release_lock(path, 'read')
+        xattrs = xattr_key(self.resolve(path))
+        self.acquire_lock(xattrs, 'read')
+        try:
+            attrs = self.files.get(xattrs)
+        finally:
+            self.release_lock(xattrs, 'read')
         
-        return attrs
+        return pickle.loads(attrs).keys() if attrs else []
   
   
     def mkdir(self, path, mode):
-        self.acquire_lock('/', 'read')
-        ht = copy.deepcopy(self.files['/'])
-        self.release_lock('/', 'read')
-	if path not in ht['content']:        
-	    self.files[path] = dict(st_mode=(S_IFDIR | mode),st_nlink=2, st_size=0, st_ctime=time(), st_mtime=time(),st_atime=time(), contents=[],r_lock=0, w_lock=0)
-        
-            ht['st_nlink'] += 1
-            ht['contents'].append(path)
-        
-            re = self.acquire_lock('/', 'write')
-            ht['r_lock'] = re[0]
-            ht['w_lock'] = re[1]
-            self.release_lock('/', 'write', copy.deepcopy(ht))
+        now = time()
+        if self.make(path, dict(st_mode=(S_IFDIR | mode),st_nlink=2, st_size=0, st_ctime=now, st_mtime=now,st_atime=now)):
+            self.link_dir(self.resolve(split_path(path)[0]), 1)
         
         
     def open(self, path, flags):
-        self.fd += 1
-        return self.fd
+        return self.handle(self.resolve(path))
+  
+  
+    # A new handle on inode ino
+    def handle(self, ino):
+        with self.buffer_lock:
+            self.fd += 1
+            self.opened[self.fd] = ino
+            return self.fd
+  
+  
+    # Inode id behind handle fh, or of path if fh was not opened here
+    def inode(self, path, fh):
+        ino = self.opened.get(fh)
+        if ino is None:
+            ino = self.resolve(path)
+        return ino
   
   
     def read(self, path, size, offset, fh):
-        self.acquire_lock(path, 'read')
-        ht = copy.deepcopy(self.files[path])
-        self.release_lock(path, 'read')
-        
-        if 'contents' in ht:
-            return ht['contents'][offset:offset + size]
-        return None
+    # Blocks are cached as pages keyed by inode and validated against the
+    # inode's version, only the missing ones go to the server
+        if size <= 0:
+            return ''
+        ino = self.inode(path, fh)
+        self.sync_ino(ino)
+        if self.pages.stale(ino):
+            self.pages.validate(ino, self.files.version(ino))
+        first = offset // BLOCK_SIZE
+        last = (offset + size - 1) // BLOCK_SIZE
+        chunks = []
+        n = first
+        while n <= last:
+            chunk = self.pages.get(ino, n)
+            if chunk is None:
+                break
+            chunks.append(chunk)
+            n += 1
+        if n <= last:
+            self.acquire_lock(ino, 'read')
+            try:
+                blocks = self.load_blocks(ino, n, last)
+            finally:
+                self.release_lock(ino, 'read')
+            for i, chunk in enumerate(blocks):
+                self.pages.put(ino, n + i, chunk)
+            chunks.extend(blocks)
+        # Only the last block of the file is short
+        eof = len(chunks) < last - first + 1 or len(chunks[-1]) < BLOCK_SIZE
+        
+        with self.buffer_lock:
+            ra = self.readahead.get(fh)
+            if ra is None:
+                ra = self.readahead[fh] = Readahead()
+        window = ra.access(offset, size, BLOCK_SIZE)
+        if window is not None and not eof:
+            self.prefetcher.submit(self.prefetch, ino, window[0], window[1])
+        
+        start = offset - first * BLOCK_SIZE
+        return ''.join(chunks)[start:start + size]
+  
+  
+    # Blocks first..last of inode ino, padded with zeros to BLOCK_SIZE or to
+    # the end of the file, whichever comes first; none past the end. Called
+    # with the read lock on ino held
+    def load_blocks(self, ino, first, last):
+        size = self.files[ino]['st_size']
+        numbers = range(first, min(last, nblocks(size) - 1) + 1)
+        blocks = []
+        for n, data in zip(numbers, self.files.get_many([block_key(ino, n) for n in numbers])):
+            data = data or ''
+            want = min(BLOCK_SIZE, size - n * BLOCK_SIZE)
+            blocks.append(data[:want] + '\0' * (want - len(data)))
+        return blocks
+  
+  
+    # Fetch the missing blocks among first..last into the cache, runs on a
+    # prefetcher thread
+    def prefetch(self, ino, first, last):
+        gen = self.pages.generation(ino)
+        missing = [n for n in range(first, last + 1)
+                   if (ino, n) not in self.pages]
+        if not missing:
+            return
+        
+        lo, hi = missing[0], missing[-1]
+        self.acquire_lock(ino, 'read')
+        try:
+            blocks = self.load_blocks(ino, lo, hi)
+        finally:
+            self.files.release_r_lock(ino, self.u_id)
+        for i, chunk in enumerate(blocks):
+            self.pages.put(ino, lo + i, chunk, gen)
   
   
     def readdir(self, path, fh):
-        self.acquire_lock('/', 'read')
-        tmp = copy.deepcopy(self.files['/'])
-        self.release_lock('/', 'read')        
-        return ['.', '..'] + [x[1:] for x in tmp['contents'] if x != '/']
+        entries_key = data_key(self.resolve(path))
+        names = ['.', '..']
+        page = self.files.dir_list(entries_key, '')
+        while page:
+            names.extend(name for name, ino in page)
+            page = self.files.dir_list(entries_key, page[-1][0])
+        return names
   
   
     def readlink(self, path):
-        self.acquire_lock(path, 'read')
-        tmp = copy.deepcopy(self.files[path])
-        self.release_lock(path, 'read')
+        ino = self.resolve(path)
+        self.acquire_lock(ino, 'read')
+        try:
+            target = self.files.get(data_key(ino))
+        finally:
+            self.release_lock(ino, 'read')
         
-        return tmp['contents']
+        return target
   
   
     def removexattr(self, path, name):
-        self.acquire_lock(path, 'read')
-        ht = copy.deepcopy(self.files[path])
-        self.release_lock(path, 'read')
-  
-        attrs = ht.get('attrs', {})
-        if name in attrs:
-            del attrs[name]
-            ht['attrs'] = attrs
-            self.acquire_lock(path, 'write')
-            self.release_lock(path, 'write', copy.deepcopy(ht))
-        else:
-            pass    # Should return ENOATTR
+        # Should return ENOATTR for a missing name
+        self.files.patch_attrs(xattr_key(self.resolve(path)), {}, "", [name])
   
   
     def rename(self, old, new):
-        self.acquire_lock(old, 'read')
-        f = copy.deepcopy(self.files[old])
-        self.release_lock(old, 'read')
-  
-        re = self.acquire_lock(new, 'write')
-        f['r_lock'] = re[0]
-        f['w_lock'] = re[1]
-        self.release_lock(new, 'write', copy.deepcopy(ht))
-        
-        self.acquire_lock(old, 'delete')
-        del self.files[old]
-        
-        self.acquire_lock('/', 'read')
-        ht = copy.deepcopy(self.files['/'])
-        self.release_lock('/', 'read')
-        
-        ht['contents'].append(new)
-        ht['contents'].remove(old)
+    # Only the directory entry moves, in one call to the server of the old
+    # directory; the inode and its data stay put. Lookups that do not depend
+    # on each other are made at the same time
+        old_parent, old_name = split_path(old)
+        new_parent, new_name = split_path(new)
+        # Resolving old resolves its parent on the way
+        ino, dst = self.files.gather((self.resolve, old), (self.resolve, new_parent))
+        src = self.resolve(old_parent)
+        if (src, old_name) == (dst, new_name):
+            return
+        attrs, target = self.files.gather((self.files.__getitem__, ino),
+                                          (self.files.dir_lookup, data_key(dst), new_name))
+        is_dir = S_ISDIR(attrs['st_mode'])
+        
+        target_attrs = None
+        if target is not None:
+            # Only a directory has entries under its data key
+            target_attrs = self.files[target]
+            if S_ISDIR(target_attrs['st_mode']) and self.files.dir_list(data_key(target), '', 1):
+                raise FuseOSError(ENOTEMPTY)
+        moved, replaced = self.files.dir_rename(data_key(src), old_name, data_key(dst), new_name)
+        self.names.invalidate_tree(old)
+        self.names.invalidate_tree(new)
+        if not moved:
+            raise FuseOSError(ENOENT)
         
-        re = self.acquire_lock('/', 'write')
-        ht['r_lock'] = re[0]
-        ht['w_lock'] = re[1]
-        self.release_lock('/', 'write', copy.deepcopy(ht))
+        calls = []
+        if replaced is not None and replaced != ino:
+            if replaced != target:
+                target_attrs = self.files[replaced]
+            if S_ISDIR(target_attrs['st_mode']):
+                calls.append((self.link_dir, dst, -1))
+            calls.append((self.free, replaced))
+        if is_dir and src != dst:
+            calls.append((self.link_dir, src, -1))
+            calls.append((self.link_dir, dst, 1))
+        self.files.gather(*calls)
 
         
         
     def rmdir(self, path):
-        self.acquire_lock(path, 'delete')
-        del self.files[path]
-        
-        self.acquire_lock('/', 'read')
-        ht = copy.deepcopy(self.files['/'])
-        self.release_lock('/', 'read')
-        
-        ht['st_nlink'] -= 1
-        ht['contents'].remove(path)
-        
-        re = self.acquire_lock('/', 'write')
-        ht['r_lock'] = re[0]
-        ht['w_lock'] = re[1]
-        self.release_lock('/', 'write', copy.deepcopy(ht))
+        ino = self.resolve(path)
+        if self.files.dir_list(data_key(ino), '', 1):
+            raise FuseOSError(ENOTEMPTY)
+        parent = self.resolve(split_path(path)[0])
+        self.files.dir_remove(data_key(parent), split_path(path)[1])
+        self.names.invalidate_tree(path)
+        self.files.gather((self.free, ino), (self.link_dir, parent, -1))
         
         
     def setxattr(self, path, name, value, options, position=0):
     # Ignore options
-        self.acquire_lock(path, 'read')
-        ht = copy.deepcopy(self.files[path])
-        self.release_lock(path, 'read')
-        
-        attrs = ht.get('attrs', {})
-        attrs[name] = value
-        ht['attrs'] = attrs
-        
-        re = self.acquire_lock(path, 'write')
-        ht['r_lock'] = re[0]
-        ht['w_lock'] = re[1]
-        self.release_lock(path, 'write', copy.deepcopy(ht))
+        self.files.patch_attrs(xattr_key(self.resolve(path)), {name: value})
         
   
     def statfs(self, path):
         return dict(f_bsize=512, f_blocks=4096, f_bavail=2048)
   
     def symlink(self, target, source):
-        self.acquire_lock('/', 'read')
-        ht = copy.deepcopy(self.files['/'])
-        self.release_lock('/', 'read')
-	if target not in ht['contents']:        
-            self.files[target] = dict(st_mode=(S_IFLNK | 0777), st_nlink=1,st_size=len(source), contents=source,r_lock=0, w_lock=0)
-	
-            ht['st_nlink'] += 1
-            ht['contents'].append(target)
-        
-            re = self.acquire_lock('/', 'write')
-            ht['r_lock'] = re[0]
-            ht['w_lock'] = re[1]
-            self.release_lock('/', 'write', copy.deepcopy(ht))
+        self.make(target, dict(st_mode=(S_IFLNK | 0777), st_nlink=1,st_size=len(source)), source)
   
   
     def truncate(self, path, length, fh=None):
-        self.acquire_lock(path, 'read')
-        ht = copy.deepcopy(self.files[path])
-        self.release_lock(path, 'read')
-        
-        if 'contents' in ht:
-            ht['contents'] = ht['contents'][:length]
-        ht['st_size'] = length
-        
-        re = self.acquire_lock(path, 'write')
-        ht['r_lock'] = re[0]
-        ht['w_lock'] = re[1]
-        self.release_lock(path, 'write', copy.deepcopy(ht))
+        ino = self.inode(path, fh)
+        self.sync_ino(ino)
+        with self.locked(ino):
+            try:
+                ht = self.files[ino]
+            except KeyError:
+                raise FuseOSError(ENOENT)
+            size, old = ht['st_size'], ht.get('blocks', 0)
+            self.patch(ino, lambda attrs: dict(st_size=length, blocks=nblocks(length)))
+            
+            # Growing leaves a hole, shrinking cuts the block the new end
+            # falls in and drops the ones after it
+            self.pages.invalidate(ino)
+            if length < size and length % BLOCK_SIZE:
+                self.files.truncate(block_key(ino, length // BLOCK_SIZE), length % BLOCK_SIZE)
+            for n in range(nblocks(length), old):
+                del self.files[block_key(ino, n)]
   
   
     def unlink(self, path):
-        self.acquire_lock('/', 'read')
-        ht = copy.deepcopy(self.files['/'])
-        self.release_lock('/', 'read')
-        
-        ht['contents'].remove(path)
-        
-        re = self.acquire_lock('/', 'write')
-        ht['r_lock'] = re[0]
-        ht['w_lock'] = re[1]
-        self.release_lock('/', 'write', copy.deepcopy(ht))
-        
-        self.acquire_lock(path, 'delete')
-        del self.files[path]
+        parent, name = split_path(path)
+        ino = self.files.dir_remove(data_key(self.resolve(parent)), name)
+        self.names.invalidate(path)
+        if ino is None:
+            raise FuseOSError(ENOENT)
+        # Writes still buffered for it are lost with the inode
+        self.free(ino)
   
   
     def utimens(self, path, times=None):
         now = time()
         
-        self.acquire_lock(path, 'read')
-        ht = copy.deepcopy(self.files[path])
-        self.release_lock(path, 'read')
-        
+        ino = self.resolve(path)
         atime, mtime = times if times else (now, now)
-        ht['st_atime'] = atime
-        ht['st_mtime'] = mtime
-        
-        re = self.acquire_lock(path, 'write')
-        ht['r_lock'] = re[0]
-        ht['w_lock'] = re[1]
-        self.release_lock(path, 'write', copy.deepcopy(ht))
+        self.files.patch_attrs(ino, dict(st_atime=atime, st_mtime=mtime))
+        self.attrs.invalidate(ino)
   
   
     def write(self, path, data, offset, fh):
-    # Get file data
-        self.acquire_lock(path, 'read')
-        ht = copy.deepcopy(self.files[path])
-        self.release_lock(path, 'read')
-        
-        tmp_data = ht['contents']
-        toffset = len(data) + offset
-        if len(tmp_data) > toffset:
-            # If this is an overwrite in the middle, handle correctly
-            ht['contents'] = tmp_data[:offset] + data + tmp_data[toffset:]
-        else:
-            # This is just an append
-            ht['contents'] = tmp_data[:offset] + data
-        ht['st_size'] = len(ht['contents'])
-        
-        re = self.acquire_lock(path, 'write')
-        ht['r_lock'] = re[0]
-        ht['w_lock'] = re[1]
-        self.release_lock(path, 'write', copy.deepcopy(ht))
+    # Buffered per handle until flush, fsync or release, or until the buffer
+    # grows too big or too old
+        buf = self.buffer(self.inode(path, fh), fh)
+        if buf.add(offset, data):
+            self.write_back(buf)
         
         return len(data)
+  
+  
+    # The handle's buffer is written back to the inode it was opened on,
+    # wherever its path went; one unlinked meanwhile went with the inode
+    def flush(self, path, fh):
+        with self.buffer_lock:
+            buf = self.buffers.get(fh)
+        if buf is not None:
+            self.write_back(buf)
+        return 0
+  
+  
+    def fsync(self, path, datasync, fh):
+        return self.flush(path, fh)
+  
+  
+    def release(self, path, fh):
+        with self.buffer_lock:
+            buf = self.buffers.pop(fh, None)
+            self.readahead.pop(fh, None)
+            self.opened.pop(fh, None)
+        if buf is not None:
+            self.write_back(buf)
+        return 0
+  
+  
+    def buffer(self, ino, fh):
+        with self.buffer_lock:
+            buf = self.buffers.get(fh)
+            if buf is None:
+                buf = self.buffers[fh] = WriteBuffer(ino)
+        self.flusher.start()
+        return buf
+  
+  
+    # Buffers of the handles open on inode ino, of every handle if ino is None
+    def handles(self, ino=None):
+        with self.buffer_lock:
+            return [buf for buf in self.buffers.values() if ino is None or buf.ino == ino]
+  
+  
+    # Send the extents buffered in buf to the server under one write lock,
+    # only the blocks they cover are touched. The size is patched first, a
+    # file gone meanwhile fails before any block is written
+    def write_back(self, buf):
+        with buf.flushing:
+            extents = buf.take()
+            if not extents:
+                return
+            ino = buf.ino
+            end = max(offset + len(data) for offset, data in extents)
+            def grow(attrs):
+                size = max(attrs['st_size'], end)
+                return dict(st_size=size, blocks=nblocks(size))
+            with self.locked(ino):
+                self.patch(ino, grow)
+                self.pages.invalidate(ino)
+                for offset, data in extents:
+                    self.write_blocks(ino, offset, data)
+  
+  
+    # Splice data into the blocks of inode ino it covers, one write_range each
+    # batched per server
+    def write_blocks(self, ino, offset, data):
+        writes = []
+        done = 0
+        while done < len(data):
+            n, start = divmod(offset + done, BLOCK_SIZE)
+            piece = data[done:done + BLOCK_SIZE - start]
+            writes.append((block_key(ino, n), start, piece))
+            done += len(piece)
+        self.files.write_ranges(writes)
+  
+  
+    # Write back every handle's buffered writes to inode ino
+    def sync_ino(self, ino):
+        for buf in self.handles(ino):
+            self.write_back(buf)
 
 if __name__ == "__main__":
     if len(argv) < 3:
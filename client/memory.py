@@ -1,7 +1,6 @@
 #!/usr/bin/env python
 
 import logging
-import copy
 from collections import defaultdict
 from errno import ENOENT
 from stat import S_IFDIR, S_IFLNK, S_IFREG
@@ -105,8 +104,7 @@ class Memory(LoggingMixIn, Operations):
 
     def read(self, path, size, offset, fh):
         self.acquire_lock(path, 'read')
-        #return self.data[path][offset:offset + size]
-        tmp = copy.deepcopy(self.data[path][offset:offset + size])
+        tmp = self.data[path][offset:offset + size]
         self.release_lock(path, 'read')
         
         return tmp
@@ -116,8 +114,7 @@ class Memory(LoggingMixIn, Operations):
 
     def readlink(self, path):
         self.acquire_lock(path, 'read')
-        #return self.data[path][offset:offset + size]
-        tmp = copy.deepcopy(self.data[path])
+        tmp = self.data[path]
         self.release_lock(path, 'read')
         
         return tmp
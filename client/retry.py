@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+"""
+Retry policy for taking locks on SimpleHT, and contention counters. Servers
+with the wait_*_lock calls park a lock request until it can be granted, so
+retries there only come from LOCK_WAIT timeouts; older servers answer at
+once and are polled, with a randomized, exponentially growing pause between
+attempts so that clients contending for a lock do not spin on it.
+"""
+
+import random
+from collections import OrderedDict
+from errno import EAGAIN
+from threading import Lock
+
+# The pause before retry n is drawn from [0, min(RETRY_CAP, RETRY_BASE * 2**n)]
+RETRY_BASE = 0.001
+RETRY_CAP = 0.5
+# Seconds a lock is waited for before the operation fails
+LOCK_DEADLINE = 60.0
+# Keys LockStats keeps counters for at most
+LOCK_STATS_KEYS = 4096
+
+class RetryPolicy:
+    """How long to pause between attempts at a lock and when to give up.
+    deadline None waits forever; past the deadline the operation fails with
+    error, EAGAIN by default (EBUSY is the other sensible choice)."""
+    def __init__(self, base=RETRY_BASE, cap=RETRY_CAP, deadline=LOCK_DEADLINE,
+                 jitter=True, error=EAGAIN):
+        self.base = base
+        self.cap = cap
+        self.deadline = deadline
+        self.jitter = jitter
+        self.error = error
+
+    # Seconds to pause before retry number n, counting from 0
+    def delay(self, n):
+        delay = min(self.cap, self.base * 2 ** min(n, 64))
+        if self.jitter:
+            return random.uniform(0, delay)
+        return delay
+
+
+class LockStats:
+    """Per lock key: times it was taken, retries, seconds spent waiting and
+    deadlines missed. Only the max_keys keys locked most recently are kept,
+    older ones start from zero again. hook, if set, is called as hook(key,
+    op, retries, waited, granted) after every acquisition, granted or not."""
+    def __init__(self, hook=None, max_keys=LOCK_STATS_KEYS):
+        self.hook = hook
+        self.max_keys = max_keys
+        self.lock = Lock()
+        # key -> counters, least recently locked first
+        self.keys = OrderedDict()
+
+    def record(self, key, op, retries, waited, granted):
+        with self.lock:
+            ent = self.keys.pop(key, None)
+            if ent is None:
+                ent = dict(acquired=0, retries=0, waited=0.0, timeouts=0)
+                if len(self.keys) >= self.max_keys:
+                    self.keys.popitem(last=False)
+            self.keys[key] = ent
+            if granted:
+                ent['acquired'] += 1
+            else:
+                ent['timeouts'] += 1
+            ent['retries'] += retries
+            ent['waited'] += waited
+        if self.hook is not None:
+            self.hook(key, op, retries, waited, granted)
+
+    # Counters of key, all zero if it was never locked
+    def get(self, key):
+        with self.lock:
+            return dict(self.keys.get(key) or dict(acquired=0, retries=0, waited=0.0, timeouts=0))
+
+    # (key, counters) of the kept keys with the most retries first
+    def contended(self, limit=10):
+        with self.lock:
+            items = [(key, dict(ent)) for key, ent in self.keys.items()]
+        items.sort(key=lambda item: -item[1]['retries'])
+        return items[:limit]
+
+
+# The function named "module.function", for a hook given on the command line
+def import_hook(name):
+    module, sep, func = name.rpartition('.')
+    return getattr(__import__(module, fromlist=[func]), func)
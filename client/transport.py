@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+"""
+Compact binary transport to SimpleHT, for servers started with --binary or
+--unix. A call is one frame each way over a connection that stays open: a 4
+byte big endian length and then the marshalled (method, params), answered
+with (True, result) or (False, (faultCode, faultString)). Binary values
+travel as byte strings and plain strings as unicode, so the proxy returned
+by connect() is called just like an xmlrpclib.Server and gives back the same
+results, and HtProxy need not care which of the two it talks to. HtProxy
+reaches every server through a Pool of such proxies, and runs independent
+calls side by side on a Pipeline.
+"""
+
+import marshal, socket, struct, sys, urlparse, xmlrpclib
+from Queue import Queue
+from threading import Event, Lock, Semaphore, Thread
+from xmlrpclib import Binary
+
+# Connections a Pool keeps to its server at most
+POOL_SIZE = 8
+# Calls that may stay parked on the server until a lock is released
+BLOCKING_CALLS = frozenset(['wait_r_lock', 'wait_w_lock', 'wait_d_lock'])
+# Threads a Pipeline runs calls on
+PIPELINE_THREADS = 8
+
+# Binary is sent as str and str as unicode, latin-1 maps every byte to a code
+# point and back
+def encode(value):
+    if isinstance(value, Binary):
+        return value.data
+    if isinstance(value, str):
+        return value.decode('latin-1')
+    if isinstance(value, (list, tuple)):
+        return [encode(v) for v in value]
+    if isinstance(value, dict):
+        return dict((encode(k), encode(v)) for k, v in value.items())
+    return value
+
+def decode(value):
+    if isinstance(value, str):
+        return Binary(value)
+    if isinstance(value, unicode):
+        return value.encode('latin-1')
+    if isinstance(value, list):
+        return [decode(v) for v in value]
+    if isinstance(value, dict):
+        return dict((decode(k), decode(v)) for k, v in value.items())
+    return value
+
+def write_frame(wfile, payload):
+    wfile.write(struct.pack('!I', len(payload)) + payload)
+    wfile.flush()
+
+# Returns the next frame, or None once the other side has closed
+def read_frame(rfile):
+    header = rfile.read(4)
+    if len(header) < 4:
+        return None
+    size = struct.unpack('!I', header)[0]
+    payload = rfile.read(size)
+    if len(payload) < size:
+        return None
+    return payload
+
+
+class BinaryProxy:
+    """One connection to the server at an ht://host:port or
+    ht+unix:///path URL, opened on first use. Like an xmlrpclib.Server it
+    must not be shared between threads."""
+    def __init__(self, url):
+        parts = urlparse.urlsplit(url)
+        if parts.scheme == 'ht+unix':
+            self.family, self.address = socket.AF_UNIX, parts.path
+        else:
+            self.family, self.address = socket.AF_INET, (parts.hostname, parts.port)
+        self.sock = None
+
+    def __getattr__(self, name):
+        return BinaryMethod(self, name)
+
+    def call(self, method, params):
+        request = marshal.dumps((method, encode(params)))
+        try:
+            if self.sock is None:
+                self.sock = socket.socket(self.family, socket.SOCK_STREAM)
+                if self.family != socket.AF_UNIX:
+                    self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                self.sock.connect(self.address)
+                self.rfile = self.sock.makefile('rb')
+                self.wfile = self.sock.makefile('wb')
+            write_frame(self.wfile, request)
+            reply = read_frame(self.rfile)
+            if reply is None:
+                raise socket.error('connection closed by %s' % (self.address,))
+        except:
+            # The connection is in an unknown state, start afresh next call
+            self.close()
+            raise
+        ok, result = marshal.loads(reply)
+        if not ok:
+            raise xmlrpclib.Fault(result[0], decode(result[1]))
+        return decode(result)
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+
+class BinaryMethod:
+    """A method name bound to a proxy, "system.multicall" style names
+    included, so xmlrpclib.MultiCall works over it as well."""
+    def __init__(self, proxy, name):
+        self.proxy = proxy
+        self.name = name
+
+    def __getattr__(self, name):
+        return BinaryMethod(self.proxy, '%s.%s' % (self.name, name))
+
+    def __call__(self, *params):
+        return self.proxy.call(self.name, params)
+
+
+# A proxy for the server at url: binary for ht:// and ht+unix:// URLs, XML-RPC
+# for anything else
+def connect(url):
+    if url.startswith('ht://') or url.startswith('ht+unix://'):
+        return BinaryProxy(url)
+    return xmlrpclib.Server(url)
+
+
+class Pool:
+    """Called like the proxy connect(url) returns, but safe to share between
+    threads: every call checks out an idle connection to the server, or
+    opens one while fewer than size exist, and hands it back when done, so
+    connections are kept open across calls (HTTP/1.1 keep-alive for
+    XML-RPC). A call that finds all size connections busy waits for one.
+    The BLOCKING_CALLS are left out of that count and get a connection
+    whenever they need one; parked on a lock, they would otherwise take up
+    the connections its holder needs to release it."""
+    def __init__(self, url, size=POOL_SIZE):
+        self.url = url
+        self.size = size
+        self.slots = Semaphore(size)
+        self.lock = Lock()
+        self.idle = []
+
+    def __getattr__(self, name):
+        return PoolMethod(self, name)
+
+    def call(self, method, params):
+        bounded = method not in BLOCKING_CALLS
+        if bounded:
+            self.slots.acquire()
+        try:
+            with self.lock:
+                conn = self.idle.pop() if self.idle else None
+            if conn is None:
+                conn = connect(self.url)
+            func = conn
+            for name in method.split('.'):
+                func = getattr(func, name)
+            # A connection a call failed on is dropped rather than reused, as
+            # is one past the size idle ones
+            result = func(*params)
+            with self.lock:
+                if len(self.idle) < self.size:
+                    self.idle.append(conn)
+            return result
+        finally:
+            if bounded:
+                self.slots.release()
+
+
+class PoolMethod:
+    """A method name bound to a Pool, like BinaryMethod."""
+    def __init__(self, pool, name):
+        self.pool = pool
+        self.name = name
+
+    def __getattr__(self, name):
+        return PoolMethod(self.pool, '%s.%s' % (self.name, name))
+
+    def __call__(self, *params):
+        return self.pool.call(self.name, params)
+
+
+class Call:
+    """func(*args), run once by whichever gets to it first: a Pipeline
+    thread, or the thread waiting for its result. So a call is never stuck
+    behind busy workers, and gather() can be used from a call in turn."""
+    def __init__(self, func, *args):
+        self.func = func
+        self.args = args
+        self.lock = Lock()
+        self.started = False
+        self.done = Event()
+        self.value = None
+        self.error = None
+
+    def run(self):
+        with self.lock:
+            if self.started:
+                return
+            self.started = True
+        try:
+            self.value = self.func(*self.args)
+        except:
+            self.error = sys.exc_info()
+        self.done.set()
+
+    # Wait for the call to finish, running it here if it has not started
+    def wait(self):
+        self.run()
+        self.done.wait()
+
+    def result(self):
+        self.wait()
+        if self.error is not None:
+            raise self.error[0], self.error[1], self.error[2]
+        return self.value
+
+
+class Pipeline:
+    """A few daemon threads to issue independent calls at the same time,
+    with gather() as the blocking front end, so a step made of such calls
+    takes as long as the slowest of them rather than their sum."""
+    def __init__(self, threads=PIPELINE_THREADS):
+        self.threads = threads
+        self.queue = None
+        self.lock = Lock()
+
+    def submit(self, func, *args):
+        call = Call(func, *args)
+        with self.lock:
+            if self.queue is None:
+                self.queue = Queue()
+                for i in range(self.threads):
+                    t = Thread(target=self.work)
+                    t.setDaemon(True)
+                    t.start()
+        self.queue.put(call)
+        return call
+
+    def work(self):
+        while True:
+            self.queue.get().run()
+
+    # Run every (func, args...) of calls at once and return their results
+    # in order. The first call runs in this thread. Once all of them are
+    # done, the first exception raised by any of them is raised again
+    def gather(self, *calls):
+        if not calls:
+            return []
+        pending = [Call(*calls[0])] + [self.submit(*call) for call in calls[1:]]
+        for call in pending:
+            call.wait()
+        return [call.result() for call in pending]
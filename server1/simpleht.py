@@ -11,37 +11,262 @@ The XmlRpc API for this library is:
       or an empty dictionary if there is no matching key
     Example usage:
       rv = rpc.get(Binary("key"))
-      print rv => {"value": Binary, "ttl": 1000}
+      print rv => {"value": Binary, "ttl": 1000, "version": "5f3a09c1:42"}
       print rv["value"].data => "value"
+  version(base64 key)
+    Returns the version of the key, an opaque string that changes whenever
+      the value does (also across server restarts), or "" if there is no
+      matching key. Lets a client revalidate a cached copy in one small call
   put(base64 key, base64 value, int ttl)
     Inserts the key / value pair into the hashtable, using the same key will
       over-write existing values
     Example usage:  rpc.put(Binary("key"), Binary("value"), 1000)
+  multi_get(base64 keys[])
+    Returns the list of what get returns for each of keys, in one call
+  multi_put(items[])
+    Does put for each [base64 key, base64 value, int ttl] of items in one
+      call, returns the list of the results
+    Example usage:
+      rpc.multi_put([[Binary("a"), Binary("1"), 1000], [Binary("b"), Binary("2"), 1000]])
+      print [rv["value"].data for rv in rpc.multi_get([Binary("a"), Binary("b")])] => ["1", "2"]
+  system.multicall(calls[])
+    Runs a batch of any of these calls in one request, see xmlrpclib.MultiCall
+    Example usage:
+      multi = xmlrpclib.MultiCall(rpc)
+      multi.write_range(Binary("a"), 0, Binary("x"), 1000)
+      multi.write_range(Binary("b"), 0, Binary("y"), 1000)
+      print tuple(multi()) => (1, 1)
   print_content()
     Print the contents of the HT
   read_file(string filename)
     Store the contents of the Hahelperable into a file
   write_file(string filename)
     Load the contents of the file into the Hahelperable
+  wait_r_lock(base64 key, base64 u_id, int timeout)
+  wait_w_lock(base64 key, base64 u_id, int timeout)
+  wait_d_lock(base64 key, base64 u_id, int timeout)
+    Blocking versions of acquire_r_lock / acquire_w_lock / acquire_d_lock.
+      The caller is parked on a per-key wait queue until the lock is granted
+      or timeout seconds have passed, and gets the same pickled status the
+      non-blocking call returns (zero when the lock was granted)
+    Example usage:
+      r = pickle.loads(rpc.wait_r_lock(Binary("key"), Binary(u_id), 10).data)
+  read_range(base64 key, int offset, int length)
+    Returns up to length bytes of the value starting at offset, as a base64
+      string that is empty past the end of the value or for a missing key
+  write_range(base64 key, int offset, base64 data, int ttl)
+    Overwrites the value from offset with data, zero-filling any gap past its
+      end and creating the key with the given ttl if needed. Returns the new
+      length of the value
+  truncate(base64 key, int length)
+    Cuts the value down (or zero-fills it up) to length bytes
+    Example usage:
+      rpc.write_range(Binary("key"), 4096, Binary("data"), 1000)
+      print rpc.read_range(Binary("key"), 4096, 4).data => "data"
+  put_new(base64 key, base64 value, int ttl)
+    Like put, but leaves an existing key alone; returns whether it stored
+  keys(base64 cursor, int limit)
+    Returns up to limit stored keys that sort after cursor, starting a scan
+      of a snapshot of the key set when cursor is empty; an empty list ends
+      the scan
+    Example usage:
+      page = rpc.keys(Binary(""), 1000)
+      page = rpc.keys(page[-1], 1000)
+  dir_add(base64 dir, base64 name, base64 inode, int ttl)
+    Adds the entry name -> inode to the directory stored under dir, creating
+      it if needed. Returns False, changing nothing, if name is taken
+  dir_remove(base64 dir, base64 name)
+    Removes name from the directory, returns the inode it named or an empty
+      base64 string if there was no such entry
+  dir_lookup(base64 dir, base64 name)
+    Returns the inode of name in the directory, or an empty base64 string
+  dir_list(base64 dir, base64 cursor, int limit)
+    Returns up to limit [name, inode] pairs of the directory whose names sort
+      after cursor, in order; an empty list ends the listing
+    Example usage:
+      rpc.dir_add(Binary("root#data"), Binary("file"), Binary("4f1c"), 10000)
+      page = rpc.dir_list(Binary("root#data"), Binary(""), 1000)
+      print page[0][0].data, page[0][1].data => "file 4f1c"
+  dir_set(base64 dir, base64 name, base64 inode)
+    Like dir_add, but replaces an existing entry; returns the inode it
+      replaced or an empty base64 string
+  dir_rename(base64 src, base64 name, base64 dst, base64 new_name)
+    Atomically moves the entry name of directory src to new_name in directory
+      dst, both stored on this server, replacing any entry there. Returns
+      [moved, replaced inode]; moved is False if src had no such entry
+  dir_move(base64 src, base64 name, base64 dst, base64 new_name, string url)
+    dir_rename for a dst stored on the server at url, which should be what
+      peer_url() returns there: this server hands the entry to that one with
+      dir_set and then drops its own, so the entry is never missing from both.
+      If the entry of src changed meanwhile, the move is undone with dir_swap
+      and [False, ""] returned, so it never ends up linked in both
+  dir_swap(base64 dir, base64 name, base64 expected, base64 inode)
+    Points name at inode, or removes it if inode is empty, but only if it
+      points at expected now (empty for no entry). Returns whether it did
+  peer_url()
+    The URL other servers reach this one at, set with --advertise and by
+      default http://<this host's fully qualified name>:<port>
+  patch_attrs(base64 key, base64 delta, string expected_version, base64 drop)
+    For a value holding a pickled dict: sets the fields of the pickled dict
+      delta and removes those named in the pickled list drop, in one step.
+      A missing key starts out as an empty dict. With expected_version not
+      "" nothing changes unless the key is still at that version. Returns the
+      new version, or "" if the patch was not applied
+    Example usage:
+      rpc.patch_attrs(Binary("ino"), Binary(pickle.dumps({"st_uid": 0})), "",
+                      Binary(pickle.dumps([])))
+
+Besides XML-RPC on --port, --binary=PORT and --unix=PATH serve the same
+calls over a compact binary transport, on TCP and on a Unix socket. A call
+is one frame each way over a connection that stays open: a 4 byte big
+endian length and then the marshalled (method, params), answered with
+(True, result) or (False, (faultCode, faultString)). Binary values travel
+as byte strings and plain strings as unicode. connect("ht://host:port") or
+connect("ht+unix:///path") returns a proxy for it that is called just like
+an xmlrpclib.Server, which connect() returns for any other URL.
+
+Started with --log=FILE, every update is appended to FILE before it is
+acknowledged and the HT is rebuilt from FILE.snap and FILE on startup. The
+log is compacted into FILE.snap in the background once it grows past
+--compact=BYTES.
 """
 
-import sys, SimpleXMLRPCServer, getopt, pickle, time, threading, xmlrpclib, unittest
-import random, copy
-from datetime import datetime, timedelta
+import sys, SimpleXMLRPCServer, SocketServer, getopt, pickle, time, threading, xmlrpclib, unittest
+import random, Queue, heapq, os, tempfile, shutil, bisect, itertools, marshal
+import socket, struct, urlparse
 from xmlrpclib import Binary   
-from threading import Lock, RLock
+from threading import Lock, RLock, Condition
+
+# Expiry deadlines are floats on a monotonic clock, so stepping the wall clock
+# neither expires every key at once nor keeps them all. On POSIX os.times()[4]
+# is the real time elapsed since a fixed point in the past, counted in clock
+# ticks; elsewhere it is 0 and the wall clock has to do
+if os.name == "posix":
+  def clock():
+    return os.times()[4]
+else:
+  clock = time.time
+
+# Append-only log of updates to the HT plus the snapshot it is compacted into.
+# Records are pickled tuples written back to back; FILE.old only exists while
+# a compaction is in flight (or was interrupted by a crash)
+class WriteAheadLog:
+  def __init__(self, path, compact_bytes = 64 << 20):
+    self.path = path
+    self.compact_bytes = compact_bytes
+    self.lock = Lock()
+    self.compacting = False
+    self.f = None
+
+  def open(self):
+    self.f = open(self.path, "ab")
+
+  # Append a record, returns True once the log is due for compaction
+  def append(self, record):
+    with self.lock:
+      pickle.dump(record, self.f, 2)
+      self.f.flush()
+      if self.compacting or self.f.tell() < self.compact_bytes:
+        return False
+      self.compacting = True
+      return True
+
+  # Feed every logged record to apply, in the order they were written
+  def replay(self, apply):
+    if os.path.exists(self.path + ".snap"):
+      f = open(self.path + ".snap", "rb")
+      for key, value, deadline in pickle.load(f):
+        apply(("put", key, value, deadline))
+      f.close()
+    for name in (self.path + ".old", self.path):
+      if not os.path.exists(name):
+        continue
+      f = open(name, "rb")
+      while True:
+        try:
+          record = pickle.load(f)
+        except (EOFError, pickle.UnpicklingError, ValueError, IndexError):
+          # End of log, or a record torn by a crash mid-append
+          break
+        apply(record)
+      f.close()
+
+  # Start a new log, called with self.lock held. Records in the old one are
+  # covered by the snapshot that is written next
+  def rotate(self):
+    self.f.close()
+    os.rename(self.path, self.path + ".old")
+    self.open()
+
+  def write_snapshot(self, entries):
+    f = open(self.path + ".snap.tmp", "wb")
+    pickle.dump(entries, f, 2)
+    f.flush()
+    os.fsync(f.fileno())
+    f.close()
+    os.rename(self.path + ".snap.tmp", self.path + ".snap")
+    if os.path.exists(self.path + ".old"):
+      os.remove(self.path + ".old")
+    self.compacting = False
+
+  def close(self):
+    with self.lock:
+      self.f.close()
+
 # Presents a HT interface
 class SimpleHT:
-  def __init__(self):
+  def __init__(self, stripes = 64, log = None, compact_bytes = 64 << 20):
+    # key -> (value, expiry deadline on clock())
     self.data = {}
-    self.next_check = datetime.now() + timedelta(minutes = 5)
+    # min-heap of (deadline, key) used to expire entries incrementally; an
+    # entry whose key has been overwritten since is stale and skipped
+    self.expiry = []
+    self.expiry_lock = Lock()
     random.seed()
     self.dump = 1
+    # self.data is guarded by striped locks, a key only ever takes the lock of
+    # its own stripe so independent keys are served in parallel; waiters on a
+    # key park on a Condition built over that stripe so release can wake them
+    self.stripes = [RLock() for i in range(stripes)]
+    self.waiters = {}
+    # lock table, key -> [r_lock, w_lock]; kept apart from the stored values
+    # so that taking a lock never unpickles or rewrites the file
+    self.locks = {}
+    # directory key -> [value, {name: inode}, sorted names or None], the
+    # decoded form of a directory, good for as long as value is still the
+    # very string stored under the key
+    self.dirs = {}
+    self.scan = None
+    self.scan_lock = Lock()
+    # key -> number of its last update, counted per server process whose
+    # epoch sets the versions apart from those handed out before a restart
+    self.versions = {}
+    self.counter = itertools.count(1)
+    self.epoch = "%08x" % random.getrandbits(32)
+    # What peer_url() hands out, set by serve()
+    self.advertised = ""
+    self.wal = None
+    if log:
+      wal = WriteAheadLog(log, compact_bytes)
+      wal.replay(self.redo)
+      with self.expiry_lock:
+        self.expiry = [(ent[1], key) for key, ent in self.data.items()]
+        heapq.heapify(self.expiry)
+      wal.open()
+      self.wal = wal
+      if os.path.exists(log + ".old"):
+        # A compaction was cut short, finish it before the next one rotates
+        wal.compacting = True
+        self.compact()
+
+  # The lock guarding key
+  def stripe(self, key):
+    return self.stripes[hash(key) % len(self.stripes)]
 
   def count(self):
     # Remove expired entries
-    self.next_check = datetime.now() - timedelta(minutes = 5)
-    self.check()
+    while self.check():
+      pass
     return len(self.data)
 
   # Retrieve something from the HT
@@ -56,134 +281,522 @@ class SimpleHT:
 
     # Remove expired entries
     self.check()
-    # Default return value
-    rv = {}
-    # If the key is in the data structure, return properly formated results
     key = key.data
-    if key in self.data:
-      ent = self.data[key]
-      now = datetime.now()
-      if ent[1] > now:
-        ttl = (ent[1] - now).seconds
-        rv = {"value": Binary(ent[0]), "ttl": ttl}
-      else:
-        del self.data[key]
-    return rv
+    with self.stripe(key):
+      # Default return value
+      rv = {}
+      # If the key is in the data structure, return properly formated results
+      if key in self.data:
+        ent = self.data[key]
+        now = clock()
+        if ent[1] > now:
+          ttl = int(ent[1] - now)
+          rv = {"value": Binary(ent[0]), "ttl": ttl, "version": self.tag(key)}
+        else:
+          del self.data[key]
+          self.versions.pop(key, None)
+          self.dirs.pop(key, None)
+      return rv
+
+  def version(self, key):
+    self.check()
+    with self.stripe(key.data):
+      if self.live(key.data) is None:
+        return ""
+      return self.tag(key.data)
+
+  # The version string of a stored key. Keys loaded from disk are all at
+  # version 0 of this process's epoch
+  def tag(self, key):
+    return "%s:%d" % (self.epoch, self.versions.get(key, 0))
 
   # Insert something into the HT
   def put(self, key, value, ttl):
     # Remove expired entries
     self.check()
-    end = datetime.now() + timedelta(seconds = ttl)
-    self.data[key.data] = (value.data, end)
+    with self.stripe(key.data):
+      self.store(key.data, value.data, ttl)
+      return True
+
+  # Batched get and put, so a client pays one round trip for many keys
+  def multi_get(self, keys):
+    return [self.get(key) for key in keys]
+
+  def multi_put(self, items):
+    return [self.put(key, value, ttl) for key, value, ttl in items]
+
+  # Insert key unless it is already there, used when migrating keys so that a
+  # copy never overwrites a value written at the new location meanwhile
+  def put_new(self, key, value, ttl):
+    self.check()
+    with self.stripe(key.data):
+      if self.live(key.data) is not None:
+        return False
+      self.store(key.data, value.data, ttl)
+      return True
+
+  # Page through the stored keys in order. The scan walks a sorted snapshot
+  # taken when it starts, so a page costs O(log n + limit)
+  def keys(self, cursor, limit):
+    with self.scan_lock:
+      if not cursor.data or self.scan is None:
+        self.scan = sorted(self.data.keys())
+      scan = self.scan
+    start = bisect.bisect_right(scan, cursor.data)
+    return [Binary(key) for key in scan[start:start + limit]]
+
+  # Byte range operations so callers only move the part of a value they touch
+  def read_range(self, key, offset, length):
+    self.check()
+    with self.stripe(key.data):
+      ent = self.live(key.data)
+      if ent is None:
+        return Binary("")
+      return Binary(ent[0][offset:offset + length])
+
+  def write_range(self, key, offset, data, ttl):
+    self.check()
+    with self.stripe(key.data):
+      size = self.splice(key.data, offset, data.data, clock() + ttl)
+      self.journal(("write", key.data, offset, data.data, time.time() + ttl))
+      return size
+
+  def truncate(self, key, length, ttl = 10000):
+    self.check()
+    with self.stripe(key.data):
+      self.resize(key.data, length, clock() + ttl)
+      self.journal(("truncate", key.data, length, time.time() + ttl))
+      return True
+
+  # Field level update of a pickled dict, so changing one attribute neither
+  # moves the whole value nor needs the client to hold a lock
+  def patch_attrs(self, key, delta, expected_version = "", drop = None):
+    self.check()
+    key = key.data
+    with self.stripe(key):
+      ent = self.live(key)
+      if expected_version and (ent is None or self.tag(key) != expected_version):
+        return ""
+      attrs = pickle.loads(ent[0]) if ent is not None and ent[0] else {}
+      attrs.update(pickle.loads(delta.data))
+      if drop is not None:
+        for field in pickle.loads(drop.data):
+          attrs.pop(field, None)
+      value = pickle.dumps(attrs, pickle.HIGHEST_PROTOCOL)
+      if ent is None:
+        self.store(key, value, 10000)
+      else:
+        self.index(key, value, ent[1], ent)
+        self.journal(("put", key, value, time.time() + ent[1] - clock()))
+      return self.tag(key)
+
+  # Directories are ordinary keys whose value is a marshalled {name: inode}
+  # dict that only these calls interpret, so an entry is added or removed in
+  # one call without the directory crossing the wire. A missing key reads as
+  # an empty directory
+  def dir_add(self, dir, name, inode, ttl = 10000):
+    self.check()
+    with self.stripe(dir.data):
+      added = self.add_entry(dir.data, name.data, inode.data, clock() + ttl)
+      if added:
+        self.journal(("dir_add", dir.data, name.data, inode.data, time.time() + ttl))
+      return added
+
+  def dir_remove(self, dir, name):
+    self.check()
+    with self.stripe(dir.data):
+      inode = self.remove_entry(dir.data, name.data)
+      if inode:
+        self.journal(("dir_remove", dir.data, name.data))
+      return Binary(inode)
+
+  def dir_lookup(self, dir, name):
+    self.check()
+    with self.stripe(dir.data):
+      return Binary(self.entries(dir.data)[0].get(name.data, ""))
+
+  def dir_list(self, dir, cursor, limit):
+    self.check()
+    with self.stripe(dir.data):
+      entries, names = self.listing(dir.data)
+      start = bisect.bisect_right(names, cursor.data)
+      return [[Binary(name), Binary(entries[name])] for name in names[start:start + limit]]
+
+  def dir_set(self, dir, name, inode, ttl = 10000):
+    self.check()
+    with self.stripe(dir.data):
+      return Binary(self.set_entry(dir.data, name.data, inode.data, ttl))
+
+  # Relinks an entry, nothing stored under the inode moves
+  def dir_rename(self, src, name, dst, new_name, ttl = 10000):
+    self.check()
+    first, second = sorted([self.stripe(src.data), self.stripe(dst.data)], key = id)
+    with first:
+      with second:
+        inode = self.remove_entry(src.data, name.data)
+        if not inode:
+          return [False, Binary("")]
+        self.journal(("dir_remove", src.data, name.data))
+        return [True, Binary(self.set_entry(dst.data, new_name.data, inode, ttl))]
+
+  def dir_move(self, src, name, dst, new_name, url):
+    self.check()
+    with self.stripe(src.data):
+      inode = self.entries(src.data)[0].get(name.data, "")
+    if not inode:
+      return [False, Binary("")]
+    peer = connect(url)
+    replaced = peer.dir_set(dst, new_name, Binary(inode))
+    with self.stripe(src.data):
+      if self.entries(src.data)[0].get(name.data) == inode:
+        self.remove_entry(src.data, name.data)
+        self.journal(("dir_remove", src.data, name.data))
+        return [True, replaced]
+    # Someone relinked or removed the name meanwhile and so took this link
+    # of the inode over; put back what dst had unless it changed as well
+    peer.dir_swap(dst, new_name, Binary(inode), replaced)
+    return [False, Binary("")]
+
+  def dir_swap(self, dir, name, expected, inode, ttl = 10000):
+    self.check()
+    with self.stripe(dir.data):
+      if self.entries(dir.data)[0].get(name.data, "") != expected.data:
+        return False
+      if inode.data:
+        self.set_entry(dir.data, name.data, inode.data, ttl)
+      elif self.remove_entry(dir.data, name.data):
+        self.journal(("dir_remove", dir.data, name.data))
+      return True
+
+  def peer_url(self):
+    return self.advertised
+
+  # Point name at inode, returns the inode it pointed at or "". Called with
+  # the key's stripe held
+  def set_entry(self, key, name, inode, ttl):
+    replaced = self.remove_entry(key, name)
+    if replaced:
+      self.journal(("dir_remove", key, name))
+    self.add_entry(key, name, inode, clock() + ttl)
+    self.journal(("dir_add", key, name, inode, time.time() + ttl))
+    return replaced
+
+  # The entries of directory key and its live entry, called with the key's
+  # stripe held. The value is only unmarshalled when it changed other than
+  # through add_entry and remove_entry
+  def entries(self, key):
+    ent = self.live(key)
+    if ent is None or not ent[0]:
+      self.dirs.pop(key, None)
+      return {}, ent
+    cached = self.dirs.get(key)
+    if cached is None or cached[0] is not ent[0]:
+      cached = self.dirs[key] = [ent[0], marshal.loads(ent[0]), None]
+    return cached[1], ent
+
+  # The entries of directory key and their names in order, called with the
+  # key's stripe held. The order is kept up to date once it is built
+  def listing(self, key):
+    entries = self.entries(key)[0]
+    cached = self.dirs.get(key)
+    if cached is None:
+      return entries, []
+    if cached[2] is None:
+      cached[2] = sorted(entries)
+    return entries, cached[2]
+
+  def add_entry(self, key, name, inode, end):
+    entries, ent = self.entries(key)
+    if name in entries:
+      return False
+    entries[name] = inode
+    self.save_entries(key, entries, ent[1] if ent else end, ent)
+    names = self.dirs[key][2]
+    if names is not None:
+      bisect.insort(names, name)
     return True
+
+  def remove_entry(self, key, name):
+    entries, ent = self.entries(key)
+    inode = entries.pop(name, "")
+    if inode:
+      self.save_entries(key, entries, ent[1], ent)
+      names = self.dirs[key][2]
+      if names is not None:
+        del names[bisect.bisect_left(names, name)]
+    return inode
+
+  # Store entries, changed in place, as the value of directory key
+  def save_entries(self, key, entries, end, ent):
+    value = marshal.dumps(entries)
+    self.index(key, value, end, ent)
+    cached = self.dirs.get(key)
+    if cached is not None and cached[1] is entries:
+      cached[0] = value
+    else:
+      self.dirs[key] = [value, entries, None]
+
+  # The entry for key unless it has expired, called with the key's stripe held
+  def live(self, key):
+    ent = self.data.get(key)
+    if ent is not None and ent[1] > clock():
+      return ent
+    return None
+
+  # Write data into key's value at offset, keeping the deadline of a live
+  # entry and using end for a new one. Called with the key's stripe held
+  def splice(self, key, offset, data, end):
+    ent = self.live(key)
+    if ent is None:
+      value = ""
+    else:
+      value, end = ent
+    if offset > len(value):
+      value += "\0" * (offset - len(value))
+    value = value[:offset] + data + value[offset + len(data):]
+    self.index(key, value, end, ent)
+    return len(value)
+
+  def resize(self, key, length, end):
+    ent = self.live(key)
+    if ent is None:
+      value = ""
+    else:
+      value, end = ent
+    if length > len(value):
+      value += "\0" * (length - len(value))
+    self.index(key, value[:length], end, ent)
+
+  # Set key to value expiring at end; only a new deadline goes into the index
+  def index(self, key, value, end, ent):
+    self.data[key] = (value, end)
+    self.versions[key] = next(self.counter)
+    if ent is None:
+      with self.expiry_lock:
+        heapq.heappush(self.expiry, (end, key))
+
+  # Set key and index its deadline, called with the key's stripe held
+  def store(self, key, value, ttl):
+    end = clock() + ttl
+    self.data[key] = (value, end)
+    self.versions[key] = next(self.counter)
+    with self.expiry_lock:
+      heapq.heappush(self.expiry, (end, key))
+    self.journal(("put", key, value, time.time() + ttl))
+
+  # Log an update if persistence is on, called with the key's stripe held so
+  # that records for one key reach the log in the order they were applied
+  def journal(self, record):
+    if self.wal and self.wal.append(record):
+      compactor = threading.Thread(target = self.compact)
+      compactor.setDaemon(True)
+      compactor.start()
+      self.compactor = compactor
+
+  # Apply a logged record while replaying, deadlines in the log are wall clock
+  def redo(self, record):
+    if record[0] == "put":
+      op, key, value, deadline = record
+      ttl = deadline - time.time()
+      if ttl > 0:
+        self.data[key] = (value, clock() + ttl)
+      else:
+        self.data.pop(key, None)
+    elif record[0] == "write":
+      op, key, offset, data, deadline = record
+      self.splice(key, offset, data, clock() + deadline - time.time())
+    elif record[0] == "truncate":
+      op, key, length, deadline = record
+      self.resize(key, length, clock() + deadline - time.time())
+    elif record[0] == "dir_add":
+      op, key, name, inode, deadline = record
+      self.add_entry(key, name, inode, clock() + deadline - time.time())
+    elif record[0] == "dir_remove":
+      op, key, name = record
+      self.remove_entry(key, name)
+
+  # Fold the log into a fresh snapshot. Only the rotation holds up writers,
+  # the snapshot itself is written from a copy of the data
+  def compact(self):
+    with self.wal.lock:
+      data = dict(self.data)
+      self.wal.rotate()
+    now = clock()
+    wall = time.time()
+    self.wal.write_snapshot([(key, ent[0], wall + ent[1] - now)
+                             for key, ent in data.items() if ent[1] > now])
    
   """
   acquire read lock
   """
   def acquire_r_lock(self, key, u_id):
-    file = copy.deepcopy(pickle.loads(self.data[key.data][0]))
-    r = file['w_lock'] 
-    user = pickle.loads(u_id.data)
-    print user, " enter acquire_R_lock"
-    print "	", key, "pre r_lock", file['r_lock']
-    print "	", key, "pre w_lock", r
-    if file['w_lock'] == 0:
-	file['r_lock'] = file['r_lock'] + 1 
-    self.check()
-    end = datetime.now() + timedelta(seconds = 10000)
-    self.data[key.data] = (pickle.dumps(file), end)
-    print "	", key, "aft r_lock", file['r_lock']	
-    print "	", key, "aft w_lock", file['w_lock']	
-    print user, " leave acquire_R_lock"	
-    return Binary(pickle.dumps(r))
+    with self.stripe(key.data):
+      lock = self.locks.setdefault(key.data, [0, 0])
+      r = lock[1]
+      user = pickle.loads(u_id.data)
+      print user, " enter acquire_R_lock"
+      print "	", key, "pre r_lock", lock[0]
+      print "	", key, "pre w_lock", r
+      if lock[1] == 0:
+        lock[0] += 1
+      print "	", key, "aft r_lock", lock[0]
+      print "	", key, "aft w_lock", lock[1]
+      print user, " leave acquire_R_lock"
+      self.drop_lock(key.data)
+      return Binary(pickle.dumps(r))
   
   """
   acquire write lock
   """
   def acquire_w_lock(self, key, u_id):
-    file = copy.deepcopy(pickle.loads(self.data[key.data][0]))
-    w = (copy.deepcopy(file['r_lock']), copy.deepcopy(file['w_lock']))
-    user = pickle.loads(u_id.data)
-    print user, "enter acquire_W_lock"
-    print "	", key, "pre r_lock", file['r_lock']
-    print "	", key, "pre w_lock", file['w_lock']
-    sum = w[0] + w[1]
-    if sum == 0:
-	file['w_lock'] = 1
-    self.check()
-    end = datetime.now() + timedelta(seconds = 10000)
-    self.data[key.data] = (pickle.dumps(file), end)
-    print "	", key, "aft r_lock", file['r_lock']
-    print "	", key, "aft w_lock", file['w_lock']
-    print user, " leave acquire_W_lock"	
-    return Binary(pickle.dumps(w))
+    with self.stripe(key.data):
+      lock = self.locks.setdefault(key.data, [0, 0])
+      w = (lock[0], lock[1])
+      user = pickle.loads(u_id.data)
+      print user, "enter acquire_W_lock"
+      print "	", key, "pre r_lock", lock[0]
+      print "	", key, "pre w_lock", lock[1]
+      if w[0] + w[1] == 0:
+        lock[1] = 1
+      print "	", key, "aft r_lock", lock[0]
+      print "	", key, "aft w_lock", lock[1]
+      print user, " leave acquire_W_lock"
+      self.drop_lock(key.data)
+      return Binary(pickle.dumps(w))
   
   """
   release read lock
   """
   def release_r_lock(self, key, u_id):
-    file = copy.deepcopy(pickle.loads(self.data[key.data][0]))
-    user = pickle.loads(u_id.data)
-    print user, "enter release_R_lock"
-    print "	", key, "pre r_lock", file['r_lock']
-    print "	", key, "pre w_lock", file['w_lock']
-    file['r_lock'] -= 1
-    self.check()
-    end = datetime.now() + timedelta(seconds = 10000)
-    self.data[key.data] = (pickle.dumps(file), end)
-    print "	", key, "aft r_lock", file['r_lock']
-    print "	", key, "aft w_lock", file['w_lock']
-    print user, " leave release_R_lock"	
-    return True
+    with self.stripe(key.data):
+      lock = self.locks.setdefault(key.data, [0, 0])
+      user = pickle.loads(u_id.data)
+      print user, "enter release_R_lock"
+      print "	", key, "pre r_lock", lock[0]
+      print "	", key, "pre w_lock", lock[1]
+      if lock[0] > 0:
+        lock[0] -= 1
+      print "	", key, "aft r_lock", lock[0]
+      print "	", key, "aft w_lock", lock[1]
+      print user, " leave release_R_lock"
+      self.drop_lock(key.data)
+      self.wake(key.data)
+      return True
 
   """
-  release write lock and write back data
+  release write lock and write back data, an empty ctx leaves the value as it is
   """
   def release_w_lock(self, key, u_id, ctx):
     self.check()
-    end = datetime.now() + timedelta(seconds = 10000)
-    self.data[key.data] = (ctx.data, end)
-    file = copy.deepcopy(pickle.loads(self.data[key.data][0]))
-    user = pickle.loads(u_id.data)
-    print user, "enter release_W_lock"
-    print "	", key, "pre r_lock", file['r_lock']
-    print "	", key, "pre w_lock", file['w_lock']
-    file['w_lock'] = 0
-    self.check()
-    end = datetime.now() + timedelta(seconds = 10000)
-    self.data[key.data] = (pickle.dumps(file), end)
-    print "	", key, "aft r_lock", file['r_lock']
-    print "	", key, "aft w_lock", file['w_lock']
-    print user, " leave release_R_lock"	
-    return True
+    with self.stripe(key.data):
+      if ctx.data:
+        self.store(key.data, ctx.data, 10000)
+      lock = self.locks.setdefault(key.data, [0, 0])
+      user = pickle.loads(u_id.data)
+      print user, "enter release_W_lock"
+      print "	", key, "pre r_lock", lock[0]
+      print "	", key, "pre w_lock", lock[1]
+      lock[1] = 0
+      print "	", key, "aft r_lock", lock[0]
+      print "	", key, "aft w_lock", lock[1]
+      print user, " leave release_W_lock"
+      self.drop_lock(key.data)
+      self.wake(key.data)
+      return True
 
   """
   acquire delete lock
   """
   def acquire_d_lock(self, key, u_id):
-    file = copy.deepcopy(pickle.loads(self.data[key.data][0]))
-    user = pickle.loads(u_id.data)
-    print user, " enter acquire_D_lock"	
-    print "	", key, "pre r_lock", file['r_lock']
-    print "	", key, "pre w_lock", file['w_lock']
-    d = file['r_lock'] + file['w_lock'] 
-    print "	", key, "aft r_lock", file['r_lock']	
-    print "	", key, "aft w_lock", file['w_lock']	
-    print user, " leave acquire_D_lock"	
-    return Binary(pickle.dumps(d))
+    with self.stripe(key.data):
+      lock = self.locks.get(key.data, (0, 0))
+      user = pickle.loads(u_id.data)
+      print user, " enter acquire_D_lock"
+      print "	", key, "pre r_lock", lock[0]
+      print "	", key, "pre w_lock", lock[1]
+      d = lock[0] + lock[1]
+      print "	", key, "aft r_lock", lock[0]
+      print "	", key, "aft w_lock", lock[1]
+      print user, " leave acquire_D_lock"
+      return Binary(pickle.dumps(d))
+
+  # Forget the lock table entry of key once nobody holds it
+  def drop_lock(self, key):
+    if self.locks.get(key) == [0, 0]:
+      del self.locks[key]
+
+  """
+  blocking lock acquisition: park on the key's wait queue until the lock is
+  granted or timeout expires, one RPC instead of a client-side poll loop
+  """
+  def wait_r_lock(self, key, u_id, timeout):
+    return self.wait_lock(key, timeout, lambda: self.acquire_r_lock(key, u_id))
+
+  def wait_w_lock(self, key, u_id, timeout):
+    return self.wait_lock(key, timeout, lambda: self.acquire_w_lock(key, u_id))
+
+  def wait_d_lock(self, key, u_id, timeout):
+    return self.wait_lock(key, timeout, lambda: self.acquire_d_lock(key, u_id))
+
+  def wait_lock(self, key, timeout, attempt):
+    end = time.time() + timeout
+    with self.stripe(key.data):
+      rv = attempt()
+      while self.busy(rv):
+        left = end - time.time()
+        if left <= 0:
+          break
+        queue = self.waiters.get(key.data)
+        if queue is None:
+          queue = self.waiters[key.data] = [Condition(self.stripe(key.data)), 0]
+        queue[1] += 1
+        queue[0].wait(left)
+        queue[1] -= 1
+        if queue[1] == 0:
+          del self.waiters[key.data]
+        rv = attempt()
+      return rv
+
+  # A lock status is (r_lock, w_lock) for write requests, a count otherwise
+  def busy(self, rv):
+    status = pickle.loads(rv.data)
+    if isinstance(status, tuple):
+      status = sum(status)
+    return status != 0
+
+  # Wake everyone parked on key, called with the key's stripe held
+  def wake(self, key):
+    queue = self.waiters.get(key)
+    if queue is not None:
+      queue[0].notify_all()
   
   # Load contents from a file
   def read_file(self, filename):
     f = open(filename.data, "rb")
-    self.data = pickle.load(f)
+    saved = pickle.load(f)
     f.close()
+    now = clock()
+    self.data = dict((key, (value, now + ttl)) for key, (value, ttl) in saved.items())
+    # Every loaded key gets a new version, a client must not take a value it
+    # cached before for the one that was read
+    self.versions = dict((key, next(self.counter)) for key in self.data)
+    with self.expiry_lock:
+      self.expiry = [(ent[1], key) for key, ent in self.data.items()]
+      heapq.heapify(self.expiry)
+    if self.wal:
+      # The loaded contents replace everything logged so far
+      with self.wal.lock:
+        self.wal.compacting = True
+      self.compact()
     return True
 
-  # Write contents to a file
+  # Write contents to a file, deadlines are saved as remaining seconds since
+  # the clock does not carry over to another process
   def write_file(self, filename):
+    now = clock()
+    saved = dict((key, (ent[0], ent[1] - now)) for key, ent in self.data.items())
     f = open(filename.data, "wb")
-    pickle.dump(self.data, f)
+    pickle.dump(saved, f)
     f.close()
     return True
 
@@ -192,18 +805,25 @@ class SimpleHT:
     print self.data
     return True
 
-  # Remove expired entries
-  def check(self):
-    now = datetime.now()
-    if self.next_check > now:
-      return
-    self.next_check = datetime.now() + timedelta(minutes = 5)
-    to_remove = []
-    for key, value in self.data.items():
-      if value[1] < now:
-        to_remove.append(key)
-    for key in to_remove:
-      del self.data[key]
+  # Remove up to batch expired entries, must be called without holding any
+  # stripe. Returns True if there may be more left to expire
+  def check(self, batch = 256):
+    now = clock()
+    expired = []
+    with self.expiry_lock:
+      while self.expiry and self.expiry[0][0] <= now and len(expired) < batch:
+        expired.append(heapq.heappop(self.expiry))
+      # Rebuild the index once overwritten keys have left it mostly stale
+      if len(self.expiry) > 2 * len(self.data) + 1024:
+        self.expiry = [(ent[1], key) for key, ent in self.data.items()]
+        heapq.heapify(self.expiry)
+    for end, key in expired:
+      with self.stripe(key):
+        if key in self.data and self.data[key][1] == end:
+          del self.data[key]
+          self.versions.pop(key, None)
+          self.dirs.pop(key, None)
+    return len(expired) == batch
        
   """
   used to test the atomicity of server
@@ -216,7 +836,7 @@ class SimpleHT:
        
        
 def main():
-  optlist, args = getopt.getopt(sys.argv[1:], "", ["port=", "test"])
+  optlist, args = getopt.getopt(sys.argv[1:], "", ["port=", "threads=", "log=", "compact=", "binary=", "unix=", "advertise=", "test"])
   ol={}
   for k,v in optlist:
     ol[k] = v
@@ -224,34 +844,257 @@ def main():
   port = 9001
   if "--port" in ol:
     port = int(ol["--port"])  
+  threads = 0
+  if "--threads" in ol:
+    threads = int(ol["--threads"])
+  log = ol.get("--log")
+  compact_bytes = 64 << 20
+  if "--compact" in ol:
+    compact_bytes = int(ol["--compact"])
+  binary = None
+  if "--binary" in ol:
+    binary = int(ol["--binary"])
+  unix = ol.get("--unix")
+  advertise = ol.get("--advertise")
   if "--test" in ol:
     sys.argv.remove("--test")
     unittest.main()
     return
-  serve(port)
+  serve(port, threads, log, compact_bytes, binary, unix, advertise)
+
+# Answer in HTTP/1.1, so a client's connection stays open for its next call
+class KeepAliveRequestHandler(SimpleXMLRPCServer.SimpleXMLRPCRequestHandler):
+  protocol_version = "HTTP/1.1"
+
+# Handle every connection in its own thread, so that a caller parked in one
+# of the wait_*_lock calls does not keep the releasing client out
+class ThreadedXMLRPCServer(SocketServer.ThreadingMixIn,
+                           SimpleXMLRPCServer.SimpleXMLRPCServer):
+  daemon_threads = True
+
+  def __init__(self, addr, requestHandler = KeepAliveRequestHandler, logRequests = True):
+    SimpleXMLRPCServer.SimpleXMLRPCServer.__init__(self, addr, requestHandler, logRequests)
+
+# Hand requests to a fixed pool of worker threads instead. Parked wait_*_lock
+# calls hold a worker, so the pool must be larger than the number of clients
+# that can wait on a lock at the same time. An open connection would hold one
+# as well, so this one answers in HTTP/1.0 and closes after every request
+class PooledXMLRPCServer(SimpleXMLRPCServer.SimpleXMLRPCServer):
+  def __init__(self, addr, threads):
+    SimpleXMLRPCServer.SimpleXMLRPCServer.__init__(self, addr)
+    self.requests = Queue.Queue()
+    for i in range(threads):
+      worker = threading.Thread(target = self.process_requests)
+      worker.setDaemon(True)
+      worker.start()
+
+  def process_requests(self):
+    while True:
+      request, client_address = self.requests.get()
+      try:
+        self.finish_request(request, client_address)
+      except:
+        self.handle_error(request, client_address)
+      self.shutdown_request(request)
+
+  def process_request(self, request, client_address):
+    self.requests.put((request, client_address))
+
+# Binary transport, see the top of the file. Binary is sent as str and str as
+# unicode, latin-1 maps every byte to a code point and back
+def encode(value):
+  if isinstance(value, Binary):
+    return value.data
+  if isinstance(value, str):
+    return value.decode("latin-1")
+  if isinstance(value, (list, tuple)):
+    return [encode(v) for v in value]
+  if isinstance(value, dict):
+    return dict((encode(k), encode(v)) for k, v in value.items())
+  return value
+
+def decode(value):
+  if isinstance(value, str):
+    return Binary(value)
+  if isinstance(value, unicode):
+    return value.encode("latin-1")
+  if isinstance(value, list):
+    return [decode(v) for v in value]
+  if isinstance(value, dict):
+    return dict((decode(k), decode(v)) for k, v in value.items())
+  return value
+
+def write_frame(wfile, payload):
+  wfile.write(struct.pack("!I", len(payload)) + payload)
+  wfile.flush()
+
+# Returns the next frame, or None once the other side has closed
+def read_frame(rfile):
+  header = rfile.read(4)
+  if len(header) < 4:
+    return None
+  size = struct.unpack("!I", header)[0]
+  payload = rfile.read(size)
+  if len(payload) < size:
+    return None
+  return payload
+
+# Serves one connection, call after call, until the client closes it
+class BinaryHandler(SocketServer.StreamRequestHandler):
+  def setup(self):
+    SocketServer.StreamRequestHandler.setup(self)
+    if self.server.address_family != socket.AF_UNIX:
+      self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+  def handle(self):
+    while True:
+      request = read_frame(self.rfile)
+      if request is None:
+        return
+      method, params = marshal.loads(request)
+      try:
+        reply = (True, encode(self.server.dispatch(method, decode(params))))
+      except xmlrpclib.Fault, fault:
+        reply = (False, (fault.faultCode, encode(fault.faultString)))
+      except:
+        exc_type, exc_value = sys.exc_info()[:2]
+        reply = (False, (1, encode("%s:%s" % (exc_type, exc_value))))
+      write_frame(self.wfile, marshal.dumps(reply))
+
+# dispatch is the _dispatch of an XML-RPC server, so both transports serve
+# the same functions, system.multicall included
+class BinaryServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+  daemon_threads = True
+  allow_reuse_address = True
+
+  def __init__(self, addr, dispatch):
+    SocketServer.TCPServer.__init__(self, addr, BinaryHandler)
+    self.dispatch = dispatch
+
+class UnixBinaryServer(BinaryServer):
+  address_family = socket.AF_UNIX
 
-# Start the xmlrpc server
-def serve(port):
-  file_server = SimpleXMLRPCServer.SimpleXMLRPCServer(('', port))
+# Client side of the binary transport, one connection per proxy. Like an
+# xmlrpclib.Server it must not be shared between threads
+class BinaryProxy:
+  def __init__(self, url):
+    parts = urlparse.urlsplit(url)
+    if parts.scheme == "ht+unix":
+      self.family, self.address = socket.AF_UNIX, parts.path
+    else:
+      self.family, self.address = socket.AF_INET, (parts.hostname, parts.port)
+    self.sock = None
+
+  def __getattr__(self, name):
+    return BinaryMethod(self, name)
+
+  def call(self, method, params):
+    request = marshal.dumps((method, encode(params)))
+    try:
+      if self.sock is None:
+        self.sock = socket.socket(self.family, socket.SOCK_STREAM)
+        if self.family != socket.AF_UNIX:
+          self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock.connect(self.address)
+        self.rfile = self.sock.makefile("rb")
+        self.wfile = self.sock.makefile("wb")
+      write_frame(self.wfile, request)
+      reply = read_frame(self.rfile)
+      if reply is None:
+        raise socket.error("connection closed by %s" % (self.address,))
+    except:
+      # The connection is in an unknown state, start afresh on the next call
+      self.close()
+      raise
+    ok, result = marshal.loads(reply)
+    if not ok:
+      raise xmlrpclib.Fault(result[0], decode(result[1]))
+    return decode(result)
+
+  def close(self):
+    if self.sock is not None:
+      self.sock.close()
+      self.sock = None
+
+# Bound to a method name, "system.multicall" style names included
+class BinaryMethod:
+  def __init__(self, proxy, name):
+    self.proxy = proxy
+    self.name = name
+
+  def __getattr__(self, name):
+    return BinaryMethod(self.proxy, "%s.%s" % (self.name, name))
+
+  def __call__(self, *params):
+    return self.proxy.call(self.name, params)
+
+# A proxy for the server at url, binary for ht:// and ht+unix:// URLs
+def connect(url):
+  if url.startswith("ht://") or url.startswith("ht+unix://"):
+    return BinaryProxy(url)
+  return xmlrpclib.Server(url)
+
+# Start the xmlrpc server, with a thread per request or a pool of threads,
+# and the binary transport on the given TCP port or Unix socket path if any
+def serve(port, threads = 0, log = None, compact_bytes = 64 << 20, binary = None, unix = None,
+          advertise = None):
+  if threads > 0:
+    file_server = PooledXMLRPCServer(('', port), threads)
+  else:
+    file_server = ThreadedXMLRPCServer(('', port))
   file_server.register_introspection_functions()
-  sht = SimpleHT()
+  file_server.register_multicall_functions()
+  sht = SimpleHT(log = log, compact_bytes = compact_bytes)
+  sht.advertised = advertise or "http://%s:%d" % (socket.getfqdn(), port)
   file_server.register_function(sht.get)
   file_server.register_function(sht.put)
+  file_server.register_function(sht.version)
+  file_server.register_function(sht.multi_get)
+  file_server.register_function(sht.multi_put)
   file_server.register_function(sht.acquire_d_lock)
   file_server.register_function(sht.acquire_r_lock)
   file_server.register_function(sht.acquire_w_lock)
   file_server.register_function(sht.release_r_lock)
   file_server.register_function(sht.release_w_lock)
+  file_server.register_function(sht.wait_r_lock)
+  file_server.register_function(sht.wait_w_lock)
+  file_server.register_function(sht.wait_d_lock)
+  file_server.register_function(sht.read_range)
+  file_server.register_function(sht.write_range)
+  file_server.register_function(sht.truncate)
+  file_server.register_function(sht.put_new)
+  file_server.register_function(sht.keys)
+  file_server.register_function(sht.patch_attrs)
+  file_server.register_function(sht.dir_add)
+  file_server.register_function(sht.dir_remove)
+  file_server.register_function(sht.dir_lookup)
+  file_server.register_function(sht.dir_list)
+  file_server.register_function(sht.dir_set)
+  file_server.register_function(sht.dir_rename)
+  file_server.register_function(sht.dir_move)
+  file_server.register_function(sht.dir_swap)
+  file_server.register_function(sht.peer_url)
   file_server.register_function(sht.test_atomicity)
   file_server.register_function(sht.print_content)
   file_server.register_function(sht.read_file)
   file_server.register_function(sht.write_file)
+  listeners = []
+  if binary is not None:
+    listeners.append(BinaryServer(('', binary), file_server._dispatch))
+  if unix is not None:
+    if os.path.exists(unix):
+      os.remove(unix)
+    listeners.append(UnixBinaryServer(unix, file_server._dispatch))
+  for listener in listeners:
+    thread = threading.Thread(target = listener.serve_forever)
+    thread.setDaemon(True)
+    thread.start()
   file_server.serve_forever()
 
 # Execute the xmlrpc in a thread ... needed for testing
 class serve_thread:
-  def __call__(self, port):
-    serve(port)
+  def __call__(self, port, threads = 0):
+    serve(port, threads)
 
 # Wrapper functions so the tests don't need to be concerned about Binary blobs
 class Helper:
@@ -264,6 +1107,61 @@ class Helper:
   def get(self, key):
     return self.caller.get(Binary(key))
 
+  def version(self, key):
+    return self.caller.version(Binary(key))
+
+  def multi_get(self, keys):
+    return self.caller.multi_get([Binary(key) for key in keys])
+
+  def multi_put(self, items):
+    return self.caller.multi_put([(Binary(key), Binary(val), ttl) for key, val, ttl in items])
+
+  def put_new(self, key, val, ttl):
+    return self.caller.put_new(Binary(key), Binary(val), ttl)
+
+  def keys(self, cursor, limit):
+    return [key.data for key in self.caller.keys(Binary(cursor), limit)]
+
+  def patch_attrs(self, key, delta, expected_version = "", drop = ()):
+    return self.caller.patch_attrs(Binary(key), Binary(pickle.dumps(delta)),
+                                   expected_version, Binary(pickle.dumps(list(drop))))
+
+  def dir_add(self, dir, name, inode):
+    return self.caller.dir_add(Binary(dir), Binary(name), Binary(inode))
+
+  def dir_remove(self, dir, name):
+    return self.caller.dir_remove(Binary(dir), Binary(name)).data
+
+  def dir_lookup(self, dir, name):
+    return self.caller.dir_lookup(Binary(dir), Binary(name)).data
+
+  def dir_list(self, dir, cursor, limit):
+    return [(name.data, inode.data) for name, inode in
+            self.caller.dir_list(Binary(dir), Binary(cursor), limit)]
+
+  def dir_set(self, dir, name, inode):
+    return self.caller.dir_set(Binary(dir), Binary(name), Binary(inode)).data
+
+  def dir_rename(self, src, name, dst, new_name):
+    moved, replaced = self.caller.dir_rename(Binary(src), Binary(name), Binary(dst), Binary(new_name))
+    return moved, replaced.data
+
+  def dir_move(self, src, name, dst, new_name, url):
+    moved, replaced = self.caller.dir_move(Binary(src), Binary(name), Binary(dst), Binary(new_name), url)
+    return moved, replaced.data
+
+  def dir_swap(self, dir, name, expected, inode):
+    return self.caller.dir_swap(Binary(dir), Binary(name), Binary(expected), Binary(inode))
+
+  def read_range(self, key, offset, length):
+    return self.caller.read_range(Binary(key), offset, length)
+
+  def write_range(self, key, offset, data, ttl):
+    return self.caller.write_range(Binary(key), offset, Binary(data), ttl)
+
+  def truncate(self, key, length):
+    return self.caller.truncate(Binary(key), length)
+
   def write_file(self, filename):
     return self.caller.write_file(Binary(filename))
 
@@ -278,8 +1176,12 @@ class Helper:
     return self.caller.acquire_d_lock(Binary(key), Binary(u_id))
   def release_r_lock(self, key, u_id):
     return self.caller.release_r_lock(Binary(key), Binary(u_id))
-  def release_w_lock(self, key, u_id):
-    return self.caller.release_w_lock(Binary(key), Binary(u_id))
+  def release_w_lock(self, key, u_id, ctx):
+    return self.caller.release_w_lock(Binary(key), Binary(u_id), Binary(ctx))
+  def wait_r_lock(self, key, u_id, timeout):
+    return self.caller.wait_r_lock(Binary(key), Binary(u_id), timeout)
+  def wait_w_lock(self, key, u_id, timeout):
+    return self.caller.wait_w_lock(Binary(key), Binary(u_id), timeout)
 
 class SimpleHTTest(unittest.TestCase):
   def test_direct(self):
@@ -291,7 +1193,8 @@ class SimpleHTTest(unittest.TestCase):
     self.assertEqual(helper.get("test")["value"], "test0", "Failed to perform overwrite")
     self.assertTrue(helper.put("test", "test1", 2), "Failed to put" )
     self.assertEqual(helper.get("test")["value"], "test1", "Failed to perform overwrite")
-    time.sleep(2)
+    # Past the ttl by more than a tick of the clock
+    time.sleep(2.1)
     self.assertEqual(helper.get("test"), {}, "Failed expire")
     self.assertTrue(helper.put("test", "test2", 20000))
     self.assertEqual(helper.get("test")["value"], "test2", "Store new value")
@@ -306,9 +1209,370 @@ class SimpleHTTest(unittest.TestCase):
     self.assertEqual(helper.get("some_other_key")["value"], "some_value", "Different keys")
     self.assertEqual(helper.get("test")["value"], "test2", "Verify contents")
 
+  def test_wait_lock(self):
+    helper = Helper(SimpleHT())
+    user = pickle.dumps(1)
+    ctx = pickle.dumps(dict(contents=''))
+    helper.put("file", ctx, 10000)
+    w = pickle.loads(helper.wait_w_lock("file", user, 1).data)
+    self.assertEqual(w, (0, 0), "Failed to take free write lock")
+    start = time.time()
+    r = pickle.loads(helper.wait_r_lock("file", user, 0.2).data)
+    self.assertNotEqual(r, 0, "Read lock granted under a write lock")
+    self.assertTrue(time.time() - start >= 0.2, "Did not wait for timeout")
+
+    # A parked reader is woken as soon as the writer lets go
+    releaser = threading.Timer(0.2, helper.release_w_lock, ("file", user, ctx))
+    releaser.start()
+    r = pickle.loads(helper.wait_r_lock("file", user, 5).data)
+    releaser.join()
+    self.assertEqual(r, 0, "Parked reader was not granted the lock")
+    self.assertEqual(helper.caller.waiters, {}, "Wait queue not cleaned up")
+
+  def test_lock_table(self):
+    helper = Helper(SimpleHT())
+    user = pickle.dumps(1)
+    helper.put("file", "opaque value", 10000)
+    self.assertEqual(pickle.loads(helper.acquire_r_lock("file", user).data), 0)
+    self.assertEqual(pickle.loads(helper.acquire_r_lock("file", user).data), 0)
+    self.assertEqual(pickle.loads(helper.acquire_w_lock("file", user).data), (2, 0))
+    self.assertEqual(pickle.loads(helper.acquire_d_lock("file", user).data), 2)
+    self.assertEqual(helper.get("file")["value"], "opaque value",
+                     "Locking touched the stored value")
+    helper.release_r_lock("file", user)
+    helper.release_r_lock("file", user)
+    self.assertEqual(helper.caller.locks, {}, "Lock table entry not dropped")
+    # Keys that are not stored yet can be locked as well
+    self.assertEqual(pickle.loads(helper.acquire_w_lock("new", user).data), (0, 0))
+    helper.release_w_lock("new", user, "created")
+    self.assertEqual(helper.get("new")["value"], "created")
+    helper.acquire_w_lock("new", user)
+    helper.acquire_w_lock("missing", user)
+    helper.release_w_lock("new", user, "")
+    helper.release_w_lock("missing", user, "")
+    self.assertEqual(helper.get("new")["value"], "created", "Empty release wrote back")
+    self.assertEqual(helper.get("missing"), {}, "Empty release created the key")
+    self.assertEqual(helper.caller.locks, {}, "Empty release kept the lock")
+
+  def test_expiry_index(self):
+    sht = SimpleHT()
+    helper = Helper(sht)
+    for i in range(1000):
+      helper.put("short%d" % i, "v", 1)
+    helper.put("long", "v", 10000)
+    # Overwriting with a longer ttl leaves a stale index entry behind
+    helper.put("renewed", "v", 1)
+    helper.put("renewed", "v2", 10000)
+    time.sleep(1.1)
+    sht.check(batch = 10)
+    self.assertEqual(len(sht.data), 1002 - 10, "Expired more than one batch")
+    self.assertEqual(sht.count(), 2, "Failed expire")
+    self.assertEqual(helper.get("renewed")["value"], "v2", "Expired a renewed key")
+    self.assertEqual(len(sht.expiry), 2, "Index not drained")
+
+  def test_batches(self):
+    helper = Helper(SimpleHT())
+    self.assertEqual(helper.multi_put([("a", "1", 10000), ("b", "2", 10000), ("a", "3", 10000)]),
+                     [True, True, True])
+    rvs = helper.multi_get(["a", "missing", "b"])
+    self.assertEqual([rv.get("value") for rv in rvs], ["3", None, "2"], "Bad batch get")
+    self.assertEqual(helper.multi_get([]), [])
+
+  def test_binary(self):
+    sht = SimpleHT()
+    dispatcher = SimpleXMLRPCServer.SimpleXMLRPCDispatcher(False, None)
+    dispatcher.register_multicall_functions()
+    for f in (sht.get, sht.put, sht.version, sht.multi_get, sht.write_range, sht.acquire_w_lock):
+      dispatcher.register_function(f)
+    tmp = tempfile.mkdtemp()
+    servers = [BinaryServer(("127.0.0.1", 0), dispatcher._dispatch),
+               UnixBinaryServer(os.path.join(tmp, "ht.sock"), dispatcher._dispatch)]
+    for server in servers:
+      thread = threading.Thread(target = server.serve_forever)
+      thread.setDaemon(True)
+      thread.start()
+    try:
+      helper = Helper(connect("ht://127.0.0.1:%d" % servers[0].server_address[1]))
+      self.assertTrue(helper.put("bin", "\0\xff" * 10, 10000), "Failed to put")
+      rv = helper.get("bin")
+      self.assertEqual(rv["value"].data, "\0\xff" * 10, "Bytes mangled")
+      self.assertEqual(rv["version"], helper.version("bin"))
+      self.assertTrue(isinstance(rv["version"], str), "String came back as Binary")
+      self.assertEqual(helper.get("missing"), {})
+      self.assertEqual(pickle.loads(helper.acquire_w_lock("bin", pickle.dumps(1)).data), (0, 0))
+
+      multi = xmlrpclib.MultiCall(helper.caller)
+      multi.write_range(Binary("a"), 0, Binary("x"), 10000)
+      multi.write_range(Binary("a"), 1, Binary("y"), 10000)
+      self.assertEqual(tuple(multi()), (1, 2), "Failed multicall")
+      self.assertRaises(xmlrpclib.Fault, helper.caller.no_such_call)
+      # The connection survives a fault
+      self.assertEqual(helper.get("a")["value"].data, "xy")
+
+      local = Helper(connect("ht+unix://" + os.path.join(tmp, "ht.sock")))
+      self.assertEqual([rv["value"].data for rv in local.multi_get(["a", "bin"])],
+                       ["xy", "\0\xff" * 10], "Failed over the Unix socket")
+    finally:
+      for server in servers:
+        server.shutdown()
+        server.server_close()
+      shutil.rmtree(tmp)
+
+  def test_ranges(self):
+    helper = Helper(SimpleHT())
+    self.assertEqual(helper.read_range("file", 0, 10), "", "Missing key not empty")
+    self.assertEqual(helper.write_range("file", 0, "hello world", 5000), 11)
+    self.assertEqual(helper.write_range("file", 6, "WORLD", 10000), 11)
+    self.assertEqual(helper.read_range("file", 6, 100), "WORLD", "Failed range read")
+    # Writing past the end leaves a zero-filled hole
+    self.assertEqual(helper.write_range("file", 13, "!", 10000), 14)
+    self.assertEqual(helper.get("file")["value"], "hello WORLD\0\0!", "Bad hole")
+    self.assertTrue(helper.truncate("file", 5))
+    self.assertEqual(helper.get("file")["value"], "hello", "Failed truncate")
+    self.assertTrue(helper.truncate("file", 7))
+    self.assertEqual(helper.get("file")["value"], "hello\0\0", "Failed extend")
+    self.assertTrue(helper.get("file")["ttl"] <= 5000, "Range write reset the ttl")
+
+  def test_versions(self):
+    helper = Helper(SimpleHT())
+    self.assertEqual(helper.version("key"), "", "Missing key has a version")
+    helper.put("key", "v", 10000)
+    v1 = helper.version("key")
+    self.assertEqual(helper.get("key")["version"], v1)
+    self.assertEqual(helper.version("key"), v1, "Version changed on read")
+    helper.write_range("key", 0, "w", 10000)
+    v2 = helper.version("key")
+    self.assertNotEqual(v1, v2, "Range write kept the version")
+    helper.truncate("key", 0)
+    self.assertNotEqual(helper.version("key"), v2, "Truncate kept the version")
+    helper.put("key", "", 0)
+    self.assertEqual(helper.version("key"), "", "Deleted key has a version")
+    helper.put("key", "v", 10000)
+    self.assertNotEqual(helper.version("key"), v1, "Recreated key reused a version")
+    tmp = tempfile.mkdtemp()
+    try:
+      dump = os.path.join(tmp, "dump")
+      helper.write_file(dump)
+      helper.put("key", "changed", 10000)
+      v3 = helper.version("key")
+      helper.read_file(dump)
+      self.assertEqual(helper.get("key")["value"], "v")
+      self.assertNotEqual(helper.version("key"), v3, "Loaded key kept the version")
+    finally:
+      shutil.rmtree(tmp)
+
+  def test_migration_calls(self):
+    helper = Helper(SimpleHT())
+    self.assertTrue(helper.put_new("key", "old", 10000), "Failed to put_new")
+    self.assertFalse(helper.put_new("key", "new", 10000), "put_new overwrote")
+    self.assertEqual(helper.get("key")["value"], "old")
+
+    for i in range(25):
+      helper.put("k%02d" % i, "v", 10000)
+    seen = []
+    page = helper.keys("", 10)
+    while page:
+      seen.extend(page)
+      # Keys stored mid-scan do not disturb the pages that follow
+      helper.put("k%02da" % len(seen), "v", 10000)
+      page = helper.keys(page[-1], 10)
+    self.assertEqual(seen, sorted(["key"] + ["k%02d" % i for i in range(25)]))
+
+  def test_patch_attrs(self):
+    helper = Helper(SimpleHT())
+    helper.put("ino", pickle.dumps({"st_mode": 0644, "st_uid": 1}), 5000)
+    version = helper.version("ino")
+    new = helper.patch_attrs("ino", {"st_uid": 2, "st_gid": 3}, version)
+    self.assertTrue(new, "Failed to patch")
+    self.assertEqual(new, helper.version("ino"))
+    self.assertEqual(pickle.loads(helper.get("ino")["value"].data),
+                     {"st_mode": 0644, "st_uid": 2, "st_gid": 3}, "Bad patch")
+    self.assertEqual(helper.patch_attrs("ino", {"st_uid": 4}, version), "",
+                     "Patched a stale version")
+    self.assertTrue(helper.patch_attrs("ino", {}, "", ["st_gid"]))
+    self.assertEqual(pickle.loads(helper.get("ino")["value"].data),
+                     {"st_mode": 0644, "st_uid": 2}, "Failed to drop a field")
+    self.assertTrue(helper.get("ino")["ttl"] <= 5000, "Patch reset the ttl")
+    self.assertTrue(helper.patch_attrs("new", {"a": 1}))
+    self.assertEqual(pickle.loads(helper.get("new")["value"].data), {"a": 1})
+
+  def test_dirs(self):
+    helper = Helper(SimpleHT())
+    self.assertEqual(helper.dir_list("dir", "", 10), [], "Missing dir not empty")
+    self.assertTrue(helper.dir_add("dir", "b", "2"), "Failed to add")
+    self.assertTrue(helper.dir_add("dir", "a", "1"), "Failed to add")
+    self.assertFalse(helper.dir_add("dir", "a", "3"), "Added a taken name")
+    self.assertEqual(helper.dir_lookup("dir", "a"), "1", "Taken name was replaced")
+    self.assertEqual(helper.dir_lookup("dir", "c"), "", "Found a missing name")
+    for i in range(20):
+      helper.dir_add("dir", "n%02d" % i, str(i))
+    seen = []
+    page = helper.dir_list("dir", "", 7)
+    while page:
+      seen.extend(page)
+      page = helper.dir_list("dir", page[-1][0], 7)
+    self.assertEqual([name for name, inode in seen],
+                     ["a", "b"] + ["n%02d" % i for i in range(20)])
+    version = helper.version("dir")
+    self.assertEqual(helper.dir_remove("dir", "a"), "1", "Failed to remove")
+    self.assertEqual(helper.dir_remove("dir", "a"), "", "Removed twice")
+    self.assertNotEqual(helper.version("dir"), version, "Remove kept the version")
+    self.assertEqual(helper.dir_list("dir", "", 1), [("b", "2")])
+    # The cached order follows later changes, and a plain put replaces it
+    helper.dir_add("dir", "m", "3")
+    helper.dir_remove("dir", "n00")
+    self.assertEqual(helper.dir_list("dir", "b", 2), [("m", "3"), ("n01", "1")])
+    helper.put("dir", marshal.dumps({"z": "9"}), 10000)
+    self.assertEqual(helper.dir_lookup("dir", "b"), "", "Stale entries after a put")
+    self.assertEqual(helper.dir_list("dir", "", 10), [("z", "9")])
+
+  def test_dir_rename(self):
+    helper = Helper(SimpleHT())
+    helper.dir_add("src", "a", "1")
+    helper.dir_add("dst", "b", "2")
+    self.assertEqual(helper.dir_set("dst", "c", "3"), "")
+    self.assertEqual(helper.dir_rename("src", "a", "dst", "b"), (True, "2"))
+    self.assertEqual(helper.dir_list("src", "", 10), [], "Entry left behind")
+    self.assertEqual(helper.dir_list("dst", "", 10), [("b", "1"), ("c", "3")])
+    self.assertEqual(helper.dir_rename("src", "a", "dst", "b"), (False, ""))
+    self.assertEqual(helper.dir_rename("dst", "b", "dst", "d"), (True, ""))
+    self.assertEqual(helper.dir_list("dst", "", 10), [("c", "3"), ("d", "1")])
+
+    # Across servers the entry goes from one to the other directly
+    far = SimpleHT()
+    server = ThreadedXMLRPCServer(("127.0.0.1", 0), logRequests = False)
+    server.register_function(far.dir_set)
+    server.register_function(far.dir_swap)
+    thread = threading.Thread(target = server.serve_forever)
+    thread.setDaemon(True)
+    thread.start()
+    try:
+      url = "http://127.0.0.1:%d" % server.server_address[1]
+      peer = Helper(far)
+      peer.dir_add("far", "e", "5")
+      self.assertEqual(helper.dir_move("dst", "c", "far", "e", url), (True, "5"))
+      self.assertEqual(helper.dir_list("dst", "", 10), [("d", "1")])
+      self.assertEqual(peer.dir_list("far", "", 10), [("e", "3")])
+      self.assertEqual(helper.dir_move("dst", "c", "far", "e", url), (False, ""))
+
+      # A source entry relinked while the entry was on its way is left to
+      # whoever relinked it, and the destination gets its old entry back
+      def dir_set(dir, name, inode):
+        helper.dir_set("dst", "d", "7")
+        return far.dir_set(dir, name, inode)
+      server.register_function(dir_set)
+      self.assertEqual(helper.dir_move("dst", "d", "far", "e", url), (False, ""))
+      self.assertEqual(helper.dir_list("dst", "", 10), [("d", "7")])
+      self.assertEqual(peer.dir_list("far", "", 10), [("e", "3")], "Moved entry left behind")
+      self.assertTrue(peer.dir_swap("far", "e", "3", ""))
+      self.assertFalse(peer.dir_swap("far", "e", "3", "4"), "Swapped a changed entry")
+      self.assertEqual(peer.dir_list("far", "", 10), [])
+    finally:
+      server.shutdown()
+      server.server_close()
+
+  def test_keep_alive(self):
+    sht = SimpleHT()
+    class CountingServer(ThreadedXMLRPCServer):
+      connections = 0
+      def process_request(self, request, client_address):
+        self.connections += 1
+        ThreadedXMLRPCServer.process_request(self, request, client_address)
+    server = CountingServer(("127.0.0.1", 0), logRequests = False)
+    server.register_function(sht.put)
+    server.register_function(sht.get)
+    thread = threading.Thread(target = server.serve_forever)
+    thread.setDaemon(True)
+    thread.start()
+    try:
+      helper = Helper(xmlrpclib.Server("http://127.0.0.1:%d" % server.server_address[1]))
+      for i in range(5):
+        helper.put("k", str(i), 10000)
+      self.assertEqual(helper.get("k")["value"].data, "4")
+      self.assertEqual(server.connections, 1, "Connection was not kept open")
+    finally:
+      server.shutdown()
+      server.server_close()
+
+  def test_wal(self):
+    tmp = tempfile.mkdtemp()
+    try:
+      log = os.path.join(tmp, "ht.log")
+      sht = SimpleHT(log = log, compact_bytes = 4096)
+      helper = Helper(sht)
+      helper.put("kept", "v0", 10000)
+      helper.put("kept", "v1", 10000)
+      helper.put("deleted", "v", 10000)
+      helper.put("deleted", "", 0)
+      helper.write_range("ranged", 0, "hello world", 10000)
+      helper.write_range("ranged", 6, "WORLD", 10000)
+      helper.truncate("ranged", 8)
+      helper.dir_add("dir", "a", "1")
+      helper.dir_add("dir", "b", "2")
+      helper.dir_remove("dir", "a")
+      sht.wal.close()
+
+      sht = SimpleHT(log = log, compact_bytes = 4096)
+      helper = Helper(sht)
+      self.assertEqual(helper.get("kept")["value"], "v1", "Replay lost an update")
+      self.assertEqual(helper.get("deleted"), {}, "Replay resurrected a key")
+      self.assertEqual(helper.get("ranged")["value"], "hello WO", "Replay lost a range write")
+      self.assertEqual(helper.dir_list("dir", "", 10), [("b", "2")], "Replay lost a dir entry")
+      self.assertFalse(os.path.exists(log + ".snap"), "Compacted too early")
+
+      # Outgrow the log so it is folded into a snapshot
+      for i in range(200):
+        helper.put("key%d" % (i % 10), "x" * 100 + str(i), 10000)
+      sht.compactor.join()
+      self.assertTrue(os.path.exists(log + ".snap"), "Log was not compacted")
+      # Puts made while that compaction ran are still in the new log, fold
+      # them in as well so that the size checked does not depend on timing
+      sht.compact()
+      self.assertEqual(os.path.getsize(log), 0, "Log was not truncated")
+      sht.wal.close()
+
+      helper = Helper(SimpleHT(log = log))
+      self.assertEqual(helper.get("kept")["value"], "v1", "Snapshot lost a key")
+      self.assertEqual(helper.get("key9")["value"], "x" * 100 + "199")
+      self.assertEqual(helper.dir_lookup("dir", "b"), "2", "Snapshot lost a dir")
+    finally:
+      shutil.rmtree(tmp)
+
+  def test_striping(self):
+    sht = SimpleHT()
+    helper = Helper(sht)
+    other = [k for k in map(str, range(100)) if sht.stripe(k) is not sht.stripe("busy")][0]
+    # A stalled request on one stripe does not hold up keys on the others
+    with sht.stripe("busy"):
+      writer = threading.Thread(target = helper.put, args = (other, "v", 10000))
+      writer.start()
+      writer.join(1)
+      self.assertFalse(writer.isAlive(), "Independent key was blocked")
+
+    # Per-key updates stay atomic under the write lock
+    user = pickle.dumps(1)
+    helper.put("counter", "0", 10000)
+    def bump():
+      for i in range(20):
+        while pickle.loads(helper.wait_w_lock("counter", user, 5).data) != (0, 0):
+          pass
+        value = int(helper.get("counter")["value"].data)
+        helper.release_w_lock("counter", user, str(value + 1))
+    old_stdout, sys.stdout = sys.stdout, open("/dev/null", "w")
+    try:
+      bumpers = [threading.Thread(target = bump) for i in range(4)]
+      for t in bumpers:
+        t.start()
+      for t in bumpers:
+        t.join()
+    finally:
+      sys.stdout.close()
+      sys.stdout = old_stdout
+    self.assertEqual(helper.get("counter")["value"].data, "80", "Lost update")
+
   # Test via RPC
   def test_xmlrpc(self):
-    output_thread = threading.Thread(target=serve_thread(), args=(9001, ))
+    output_thread = threading.Thread(target=serve_thread(), args=(9001, 4))
     output_thread.setDaemon(True)
     output_thread.start()
 
@@ -321,10 +1585,22 @@ class SimpleHTTest(unittest.TestCase):
     self.assertEqual(helper.get("test")["value"], "test0", "Failed to perform overwrite")
     self.assertTrue(helper.put("test", "test1", 2), "Failed to put" )
     self.assertEqual(helper.get("test")["value"], "test1", "Failed to perform overwrite")
-    time.sleep(2)
+    # Past the ttl by more than a tick of the clock
+    time.sleep(2.1)
     self.assertEqual(helper.get("test"), {}, "Failed expire")
     self.assertTrue(helper.put("test", "test2", 20000))
     self.assertEqual(helper.get("test")["value"], "test2", "Store new value")
 
+    # Batches of calls go in one request
+    multi = xmlrpclib.MultiCall(helper.caller)
+    multi.write_range(Binary("batch"), 0, Binary("hello"), 10000)
+    multi.write_range(Binary("other"), 0, Binary("world"), 10000)
+    multi.read_range(Binary("batch"), 1, 3)
+    lengths = tuple(multi())
+    self.assertEqual(lengths[:2], (5, 5))
+    self.assertEqual(lengths[2].data, "ell", "Failed multicall")
+    self.assertEqual([rv["value"].data for rv in helper.multi_get(["batch", "other"])],
+                     ["hello", "world"])
+
 if __name__ == "__main__":
   main()
@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+"""
+Microbenchmark of the attribute round trip of a write back or truncate in
+the client: the pickled attributes of an inode are loaded, changed and
+pickled again as the ctx of release_w_lock. The old path deep-copied them
+after loading and again before releasing and pickled with protocol 0; the
+current one changes the loaded dict in place and pickles it with the highest
+protocol. Reports the time per op and the bytes of ctx sent to the server.
+
+usage: python bench_attrs.py [ops]
+"""
+import copy, pickle, sys, timeit
+from time import time
+
+now = time()
+ATTRS = pickle.dumps(dict(st_mode=0100644, st_nlink=1, st_size=123456789,
+                          blocks=1884, st_ctime=now, st_mtime=now, st_atime=now,
+                          st_uid=1000, st_gid=1000))
+
+def before():
+    ht = copy.deepcopy(pickle.loads(ATTRS))
+    ht['st_size'] = max(ht['st_size'], 123456789 + 4096)
+    ht['blocks'] = ht['st_size'] // 65536 + 1
+    return pickle.dumps(copy.deepcopy(ht))
+
+def after():
+    ht = pickle.loads(ATTRS)
+    ht['st_size'] = max(ht['st_size'], 123456789 + 4096)
+    ht['blocks'] = ht['st_size'] // 65536 + 1
+    return pickle.dumps(ht, pickle.HIGHEST_PROTOCOL)
+
+def main():
+    ops = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    assert pickle.loads(before()) == pickle.loads(after())
+    for name, op in [('deepcopy', before), ('in place', after)]:
+        seconds = min(timeit.repeat(op, number=ops, repeat=3))
+        print '%-9s %6.2f us/op  %4d bytes of ctx' % (name, seconds / ops * 1e6, len(op()))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+"""
+Checks the client's write buffering: WriteBuffer merging, the Flusher that
+writes back buffers past their age, and Memory writing back a handle's
+buffer to the inode it was opened on when it is flushed or released. Runs a
+SimpleHT from server0 in this process.
+
+usage: python test_cache.py
+"""
+import os, sys, threading, time, unittest
+from errno import ENOENT
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, '..', 'client'))
+sys.path.insert(0, os.path.join(here, '..', 'server0'))
+import simpleht
+from cache import WriteBuffer, Flusher
+from multi_cs import HtProxy, Memory, FuseOSError
+
+class WriteBufferTest(unittest.TestCase):
+  def test_merges_overlapping_and_adjacent(self):
+    buf = WriteBuffer("ino")
+    buf.add(0, "aaaa")
+    buf.add(4, "bb")
+    buf.add(10, "cc")
+    self.assertEqual(len(buf.extents), 2, "Adjacent writes were not merged")
+    self.assertEqual(buf.end(), 12)
+    buf.add(5, "xxxxxx")
+    self.assertEqual(buf.take(), [(0, "aaaabxxxxxxc")], "Bridging write was not merged")
+    self.assertEqual(buf.end(), 0)
+    self.assertEqual(buf.size, 0)
+
+  def test_overwrite_in_place(self):
+    buf = WriteBuffer("ino")
+    buf.add(0, "abcdef")
+    buf.add(2, "XY")
+    self.assertEqual(buf.size, 6)
+    self.assertEqual(buf.take(), [(0, "abXYef")])
+
+  def test_limit_and_age(self):
+    buf = WriteBuffer("ino", limit = 8, age = 60)
+    self.assertFalse(buf.expired(), "An empty buffer expired")
+    self.assertFalse(buf.add(0, "abcd"))
+    self.assertTrue(buf.add(4, "efgh"), "Full buffer did not ask to be written back")
+    self.assertFalse(buf.expired())
+    self.assertTrue(buf.expired(time.time() + 60))
+    buf.take()
+    self.assertFalse(buf.expired(time.time() + 60), "A taken buffer expired")
+
+class FlusherTest(unittest.TestCase):
+  def test_flushes_only_expired(self):
+    old = WriteBuffer("old", age = 0)
+    old.add(0, "a")
+    new = WriteBuffer("new", age = 60)
+    new.add(0, "b")
+    sent = []
+    flusher = Flusher(lambda: [old, new], sent.append)
+    self.assertEqual(flusher.flush(), 1)
+    self.assertEqual(sent, [old])
+
+  def test_thread_survives_failures(self):
+    buf = WriteBuffer("ino", age = 0)
+    buf.add(0, "a")
+    calls = []
+    def write_back(buf):
+      calls.append(buf)
+      if len(calls) == 1:
+        raise FuseOSError(ENOENT)
+      buf.take()
+    flusher = Flusher(lambda: [buf], write_back, 0.01)
+    flusher.start()
+    flusher.start()
+    deadline = time.time() + 5
+    while len(calls) < 2 and time.time() < deadline:
+      time.sleep(0.01)
+    self.assertTrue(len(calls) >= 2, "Flusher stopped after a failed write back")
+    self.assertEqual(buf.end(), 0)
+
+class HandleTest(unittest.TestCase):
+  def setUp(self):
+    self.sht = simpleht.SimpleHT()
+    self.server = simpleht.ThreadedXMLRPCServer(("127.0.0.1", 0), logRequests = False)
+    self.server.register_introspection_functions()
+    self.server.register_multicall_functions()
+    for name in ("get", "put", "version", "multi_get", "multi_put",
+                 "acquire_d_lock", "acquire_r_lock", "acquire_w_lock",
+                 "release_r_lock", "release_w_lock", "wait_r_lock",
+                 "wait_w_lock", "wait_d_lock", "read_range", "write_range",
+                 "truncate", "put_new", "patch_attrs", "dir_add", "dir_remove",
+                 "dir_lookup", "dir_list", "dir_set", "dir_rename", "dir_move",
+                 "dir_swap", "peer_url"):
+      self.server.register_function(getattr(self.sht, name))
+    thread = threading.Thread(target = self.server.serve_forever)
+    thread.setDaemon(True)
+    thread.start()
+    self.url = "http://127.0.0.1:%d" % self.server.server_address[1]
+    self.fs = self.client(1)
+
+  def tearDown(self):
+    self.server.shutdown()
+    self.server.server_close()
+
+  def client(self, u_id):
+    return Memory(HtProxy([self.url]), u_id, 0)
+
+  def test_flush_after_rename(self):
+    fh = self.fs.create("/f", 0644)
+    self.fs.write("/f", "data", 0, fh)
+    self.fs.rename("/f", "/g")
+    self.assertEqual(self.fs.flush("/f", fh), 0)
+    other = self.client(2)
+    self.assertEqual(other.read("/g", 10, 0, None), "data", "Flushed data went missing")
+    self.fs.write("/f", "more", 4, fh)
+    self.assertEqual(self.fs.release("/f", fh), 0)
+    self.assertEqual(other.read("/g", 10, 0, None), "datamore", "Released data went missing")
+    self.assertEqual(self.fs.buffers, {})
+    self.assertEqual(self.fs.opened, {})
+
+  def test_release_after_unlink(self):
+    fh = self.fs.create("/f", 0644)
+    self.fs.write("/f", "data", 0, fh)
+    self.fs.unlink("/f")
+    self.assertEqual(self.fs.release("/f", fh), 0)
+    self.assertEqual(self.fs.buffers, {})
+
+  def test_release_reports_errors(self):
+    fh = self.fs.create("/f", 0644)
+    self.fs.write("/f", "data", 0, fh)
+    self.client(2).unlink("/f")
+    try:
+      self.fs.release("/f", fh)
+      self.fail("Release of a file removed by another client succeeded")
+    except FuseOSError, e:
+      self.assertEqual(e.errno, ENOENT)
+    self.assertEqual(self.fs.buffers, {}, "Released buffer leaked")
+
+  def test_flusher_writes_idle_handle(self):
+    fh = self.fs.create("/f", 0644)
+    self.fs.write("/f", "data", 0, fh)
+    self.fs.buffers[fh].age = 0
+    self.assertEqual(self.fs.flusher.flush(), 1)
+    self.assertEqual(self.client(2).read("/f", 10, 0, None), "data")
+    self.assertEqual(self.fs.flusher.flush(), 0)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+"""
+Checks that a client's connection Pool keeps working while other calls
+through it are parked on a lock: the holder of the lock must still get a
+connection to release it. Runs a SimpleHT from server0 in this process.
+
+usage: python test_pool.py
+"""
+import os, pickle, sys, threading, time, unittest
+from xmlrpclib import Binary
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, '..', 'client'))
+sys.path.insert(0, os.path.join(here, '..', 'server0'))
+import simpleht
+from transport import Pool
+
+class PoolTest(unittest.TestCase):
+  def setUp(self):
+    self.sht = simpleht.SimpleHT()
+    self.server = simpleht.ThreadedXMLRPCServer(("127.0.0.1", 0), logRequests = False)
+    for name in ("acquire_w_lock", "release_w_lock", "wait_w_lock"):
+      self.server.register_function(getattr(self.sht, name))
+    thread = threading.Thread(target = self.server.serve_forever)
+    thread.setDaemon(True)
+    thread.start()
+    self.url = "http://127.0.0.1:%d" % self.server.server_address[1]
+
+  def tearDown(self):
+    self.server.shutdown()
+    self.server.server_close()
+
+  def test_release_while_waiters_park(self):
+    pool = Pool(self.url, 2)
+    key = Binary("key")
+    holder = Binary(pickle.dumps(0))
+    self.assertEqual(pickle.loads(pool.acquire_w_lock(key, holder).data), (0, 0))
+    waiters = []
+    granted = []
+    def wait(user):
+      status = pool.wait_w_lock(key, Binary(pickle.dumps(user)), 5)
+      granted.append(pickle.loads(status.data) == (0, 0))
+      if granted[-1]:
+        pool.release_w_lock(key, Binary(pickle.dumps(user)), Binary(""))
+    for user in range(1, 3):
+      waiter = threading.Thread(target = wait, args = (user,))
+      waiter.setDaemon(True)
+      waiter.start()
+      waiters.append(waiter)
+    time.sleep(0.3)
+    start = time.time()
+    pool.release_w_lock(key, holder, Binary(""))
+    self.assertTrue(time.time() - start < 1, "Release waited for a parked call")
+    for waiter in waiters:
+      waiter.join()
+    self.assertEqual(granted, [True, True], "A waiter missed the lock")
+    self.assertTrue(len(pool.idle) <= 2, "Pool kept too many connections")
+
+if __name__ == '__main__':
+  unittest.main()